@@ -0,0 +1,94 @@
+"""Micro-benchmark of download throughput against chunk size.
+
+Serves a file from a local HTTP server and streams it to disk with
+stream_to_file at several chunk sizes, next to the old 1 KB iter_content
+loop for reference.
+
+    python benchmarks/chunk_size.py --size 200 --repeat 3
+"""
+
+import os
+import sys
+import time
+import hashlib
+import argparse
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+from common import load_catcher
+
+CHUNK_SIZES = [1024, 16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024]
+
+
+def serve(payload):
+    """Start a local server returning payload for every GET"""
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'video/mp4')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def legacy_copy(resp, file, digest, chunk_size):
+    """The original loop: one write per iter_content chunk"""
+    written = 0
+    for chunk in resp.iter_content(chunk_size):
+        file.write(chunk)
+        digest.update(chunk)
+        written += len(chunk)
+    return written
+
+
+def measure(session, url, copy, chunk_size, repeat, directory):
+    best = None
+    for _ in range(repeat):
+        with tempfile.NamedTemporaryFile(dir=directory) as file:
+            start = time.perf_counter()
+            with session.get(url, stream=True) as resp:
+                written = copy(resp, file, hashlib.sha256(), chunk_size)
+            file.flush()
+            os.fsync(file.fileno())
+            elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return written, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size', type=int, default=200, help='payload size in MB')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per chunk size, the best is reported')
+    parser.add_argument('--dir', default=None, help='directory to write to (defaults to the temp dir)')
+    args = parser.parse_args()
+
+    catcher = load_catcher()
+    server = serve(os.urandom(args.size * 1024 * 1024))
+    url = 'http://127.0.0.1:%d/media' % server.server_port
+    session = requests.Session()
+
+    print('%-24s %12s %10s' % ('method', 'chunk size', 'MB/s'))
+    runs = [('iter_content (old)', legacy_copy, 1024)]
+    runs += [('stream_to_file', catcher.stream_to_file, size) for size in CHUNK_SIZES]
+    for name, copy, chunk_size in runs:
+        written, elapsed = measure(session, url, copy, chunk_size, args.repeat, args.dir)
+        print('%-24s %12d %10.1f' % (name, chunk_size, written / elapsed / 1024 / 1024))
+
+    server.shutdown()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
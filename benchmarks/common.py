@@ -0,0 +1,16 @@
+"""Helpers shared by the benchmark scripts."""
+
+import sys
+import importlib.util
+from os.path import abspath, dirname, join
+
+
+def load_catcher():
+    """Import tadpole-catcher.py (its name is not a valid module name)"""
+    path = join(dirname(dirname(abspath(__file__))), 'tadpole-catcher.py')
+    spec = importlib.util.spec_from_file_location('tadpole_catcher', path)
+    module = importlib.util.module_from_spec(spec)
+    # Registered so that its functions can be pickled, e.g. for process pools
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,180 @@
+"""End to end benchmark of the client against the local fake Tadpoles server.
+
+Starts a FakeTadpoles server, points a Client at it with a throwaway
+settings and download directory, runs download_images and reports
+throughput, where the time went and peak memory.
+
+    python benchmarks/end_to_end.py --backend api --children 3 --months 6
+    python benchmarks/end_to_end.py --backend browser --latency 0.05
+
+The browser backend needs Chrome and chromedriver; the api backend runs
+without a browser (the session cookie is pre-seeded, as on a warm run).
+Wait, WebDriver and HTTP times are summed over all threads, so with
+several download workers they can add up to more than the wall time.
+"""
+
+import os
+import sys
+import json
+import time
+import pickle
+import shutil
+import argparse
+import resource
+import tempfile
+import threading
+import tracemalloc
+from configparser import ConfigParser
+
+from common import load_catcher
+from fake_tadpoles import FakeAccount, FakeTadpoles, SESSION_COOKIE
+
+
+class Timers(object):
+    '''Cumulative seconds per category, with waits excluded from WebDriver
+    time (the wait conditions poll the browser themselves).
+    '''
+    def __init__(self):
+        self.totals = {'wait': 0.0, 'webdriver': 0.0, 'http': 0.0}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def wrap(self, owner, name, category):
+        original = getattr(owner, name)
+        timers = self
+
+        def timed(*args, **kwargs):
+            nested = getattr(timers.local, 'category', None)
+            if nested is not None:
+                return original(*args, **kwargs)
+            timers.local.category = category
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                timers.local.category = None
+                with timers.lock:
+                    timers.totals[category] += time.perf_counter() - start
+        setattr(owner, name, timed)
+
+
+def make_config(args, server, download_dir):
+    cfg = ConfigParser()
+    cfg['AUTHENTICATION'] = {'username': 'bench@example.com', 'password': 'secret'}
+    cfg['DOWNLOADS'] = {
+        'max_retries': '5',
+        'retry_backoff': '0.05',
+        'default_download_dir': download_dir,
+        'concurrency': str(args.concurrency),
+        'rate_limit': str(args.rate_limit),
+        'pool_size': str(args.concurrency),
+    }
+    cfg['CRAWLER'] = {
+        'backend': args.backend,
+        'api_url': server.url,
+        'browsers': str(args.browsers),
+    }
+    cfg['BROWSER'] = {'headless': 'yes'}
+    cfg['METRICS'] = {'json_file': 'metrics.json', 'prometheus_file': 'metrics.prom'}
+    return cfg
+
+
+def instrument(catcher, timers):
+    from selenium.webdriver.remote.webdriver import WebDriver
+    timers.wrap(catcher.Client, 'wait_for', 'wait')
+    timers.wrap(catcher.RateLimiter, 'wait', 'wait')
+    timers.wrap(WebDriver, 'execute', 'webdriver')
+    timers.wrap(catcher.Client, 'download_part', 'http')
+    timers.wrap(catcher.Client, 'api_get', 'http')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--backend', choices=['api', 'browser'], default='api')
+    parser.add_argument('--children', type=int, default=2)
+    parser.add_argument('--months', type=int, default=3)
+    parser.add_argument('--items', type=int, default=30, help='media items per child and month')
+    parser.add_argument('--size', type=int, default=200, help='media size in KB')
+    parser.add_argument('--video-ratio', type=float, default=0.1)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--media-latency', type=float, default=0.0, help='extra seconds per media request')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='fraction of media requests failing with 503')
+    parser.add_argument('--truncate-rate', type=float, default=0.0, help='fraction of media bodies cut off')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--rate-limit', type=float, default=0, help='requests per second per host, 0 for none')
+    parser.add_argument('--browsers', type=int, default=1)
+    parser.add_argument('--json', dest='json_path', help='also write the results to this file')
+    parser.add_argument('--keep', action='store_true', help='keep the download dir and logs')
+    args = parser.parse_args()
+    if args.json_path:
+        args.json_path = os.path.abspath(args.json_path)
+
+    catcher = load_catcher()
+    account = FakeAccount(children=args.children, months=args.months, items_per_month=args.items,
+                          media_size=args.size * 1024, video_ratio=args.video_ratio)
+    server = FakeTadpoles(account, latency=args.latency, media_latency=args.media_latency,
+                          failure_rate=args.failure_rate, truncate_rate=args.truncate_rate).start()
+
+    workdir = tempfile.mkdtemp(prefix='tadpole-bench-')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    download_dir = os.path.join(workdir, 'download')
+    config = make_config(args, server, download_dir)
+
+    catcher.Client.ROOT_URL = server.url + '/parents'
+    catcher.Client.HOME_URL = server.url + '/parents'
+    catcher.Image.BASE_URL = server.url
+    if args.backend == 'api':
+        # Warm start: skip the browser login entirely
+        with open(catcher.Client.COOKIE_FILE, 'wb') as file:
+            pickle.dump([{'name': SESSION_COOKIE, 'value': '1', 'domain': '127.0.0.1', 'path': '/'}], file)
+
+    timers = Timers()
+    instrument(catcher, timers)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    with catcher.Client(config) as client:
+        client.download_images()
+    elapsed = time.perf_counter() - start
+    _, peak_python = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    server.stop()
+
+    entries = list(client.manifest.entries.values())
+    media = [entry for entry in entries if entry['type'] != 'text/html']
+    saved_bytes = sum(entry['size'] for entry in entries)
+    results = {
+        'backend': args.backend,
+        'elapsed_s': round(elapsed, 3),
+        'media_saved': len(media),
+        'media_expected': account.media_count,
+        'reports_saved': len(entries) - len(media),
+        'reports_expected': account.report_count,
+        'items_per_s': round(len(entries) / elapsed, 2),
+        'mb_per_s': round(saved_bytes / elapsed / 1024 / 1024, 2),
+        'wait_s': round(timers.totals['wait'], 3),
+        'webdriver_s': round(timers.totals['webdriver'], 3),
+        'http_s': round(timers.totals['http'], 3),
+        'peak_python_mb': round(peak_python / 1024 / 1024, 1),
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'server': server.stats,
+    }
+    for name, value in results.items():
+        print('%-16s %s' % (name, value))
+    # The client's own instrumentation, only in the JSON output
+    results['metrics'] = client.metrics.summary()
+    if args.json_path:
+        with open(args.json_path, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    os.chdir(cwd)
+    if args.keep:
+        print('Kept %s' % workdir)
+    else:
+        shutil.rmtree(workdir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,430 @@
+"""A local stand-in for www.tadpoles.com.
+
+Serves the login form, the parents home page (month tiles, child tabs,
+the 'All' button, the left-panel timeline and report modals), the JSON
+API used by the api backend and the media endpoint, all generated from a
+FakeAccount. Latency, media sizes and failure rates are configurable so
+the client can be benchmarked without touching the live site.
+
+    python benchmarks/fake_tadpoles.py --port 8000
+"""
+
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from datetime import datetime
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+SESSION_COOKIE = 'fake_session'
+MONTHS = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+MAGIC = {'image/jpeg': b'\xff\xd8\xff\xe0', 'video/mp4': b'\x00\x00\x00\x18ftypmp42'}
+
+
+class FakeAccount(object):
+    '''Deterministic timeline data: children, months (newest first) and, for
+    every child and month, days of media followed by that day's report.
+    '''
+    def __init__(self, children=2, months=3, items_per_month=30, days_per_month=10,
+                 media_size=200 * 1024, video_ratio=0.1, seed=0):
+        rand = random.Random(seed)
+        self.media_size = media_size
+        self.children = [{'display_name': '%s Test' % name, 'key': 'child%d' % ind}
+                         for ind, name in enumerate(['Ann', 'Ben', 'Cat', 'Dan', 'Eve', 'Fay'][:children])]
+        newest = datetime(2020, 12, 1)
+        self.months = []
+        for ind in range(months):
+            month = newest.month - ind
+            year = newest.year + (month - 1) // 12
+            self.months.append((year, (month - 1) % 12 + 1))
+        self.timelines = {}
+        for child in range(children):
+            for year, month in self.months:
+                items = []
+                days = sorted(rand.sample(range(1, 29), min(days_per_month, 28)), reverse=True)
+                for day_ind, day in enumerate(days):
+                    count = items_per_month // len(days) + (1 if day_ind < items_per_month % len(days) else 0)
+                    for _ in range(count):
+                        ident = '%032x' % rand.getrandbits(128)
+                        items.append({
+                            'kind': 'media',
+                            'id': ident,
+                            'key': 'k' + ident[:24],
+                            'event': 'e' + ident[:16],
+                            'type': 'video/mp4' if rand.random() < video_ratio else 'image/jpeg',
+                            'day': day,
+                        })
+                    items.append({'kind': 'report', 'day': day, 'id': '%032x' % rand.getrandbits(128)})
+                self.timelines[(child, year, month)] = items
+        self.media = {item['key']: item for items in self.timelines.values()
+                      for item in items if item['kind'] == 'media'}
+
+    @property
+    def media_count(self):
+        return len(self.media)
+
+    @property
+    def report_count(self):
+        return sum(1 for items in self.timelines.values() for item in items if item['kind'] == 'report')
+
+    def payload(self, key):
+        """Bytes of a media item: a valid magic number followed by filler"""
+        item = self.media[key]
+        head = MAGIC[item['type']] + item['key'].encode()
+        return head + b'\0' * max(0, self.media_size - len(head))
+
+    def timeline(self, child, year, month):
+        """Timeline items as rendered by the home page"""
+        records = []
+        for ind, item in enumerate(self.timelines.get((child, year, month), [])):
+            if item['kind'] == 'media':
+                # The site puts the thumbnail parameter before or after the key
+                query = ('obj=%s&thumbnail=true&key=%s' if ind % 2 else 'obj=%s&key=%s&thumbnail=true') \
+                    % (item['event'], item['key'])
+                records.append({
+                    'id': 'tl-' + item['id'],
+                    'style': 'background-image: url("/remote/v1/obj_attachment?%s");' % query,
+                })
+            else:
+                records.append({'id': 'tl-' + item['id'],
+                                'report': 'Daily report',
+                                'date': '%02d/%02d/%d' % (month, item['day'], year)})
+        return records
+
+    def report_html(self, child, year, month, day):
+        name = self.children[child]['display_name']
+        return '<h1>%s %d/%d/%d</h1><p>Ate lunch. Napped for 2 hours.</p>' % (name, month, day, year)
+
+    def app_params(self):
+        first = self.months[-1]
+        last = self.months[0]
+        params = {
+            'first_event_time': int(datetime(first[0], first[1], 1).timestamp()),
+            'last_event_time': int(datetime(last[0], last[1], 28, 12).timestamp()),
+        }
+        if len(self.children) > 1:
+            params['children'] = self.children
+        return params
+
+    def events(self, earliest, latest):
+        """API events with an event_time in [earliest, latest)"""
+        events = []
+        for (child, year, month), items in self.timelines.items():
+            member = self.children[child]
+            for ind, item in enumerate(items):
+                stamp = int(datetime(year, month, item['day'], 8).timestamp()) + ind
+                if not earliest <= stamp < latest:
+                    continue
+                event = {
+                    'event_time': stamp,
+                    'event_date': '%d-%02d-%02d' % (year, month, item['day']),
+                    'member': member['key'],
+                    'member_display': member['display_name'],
+                }
+                if item['kind'] == 'media':
+                    event.update(type='Activity', key=item['event'],
+                                 attachments=[{'key': item['key'], 'mime_type': item['type']}])
+                else:
+                    event.update(type='DailyReport', key='r' + item['id'][:16],
+                                 entries=[{'type': 'meal', 'note': 'Ate lunch'},
+                                          {'type': 'nap', 'note': 'Napped for 2 hours'}])
+                events.append(event)
+        return sorted(events, key=lambda event: event['event_time'])
+
+
+LOGIN_PAGE = '''<!DOCTYPE html>
+<html><body>
+<button id="login-button">Log in</button>
+<div class="tp-block-half">Parents</div>
+<div class="other-login-button">Other login</div>
+<form class="form-horizontal" method="post" action="/login">
+  <input type="text" name="email">
+  <input type="password" name="password">
+  <button type="submit">Submit</button>
+</form>
+</body></html>
+'''
+
+# The layout matches the xpaths the crawler uses; nested <li>s cannot be
+# written as markup, so the page is built with DOM calls.
+HOME_PAGE = '''<!DOCTYPE html>
+<html><body>
+<div id="app"></div>
+<script>
+var tadpoles = {appParams: %(params)s};
+var MONTHS = %(months)s;
+var CHILDREN = %(children)s;
+var state = {child: 0, month: 0, all: false};
+
+function el(tag, parent, text) {
+    var node = document.createElement(tag);
+    if (text !== undefined) { node.textContent = text; }
+    if (parent) { parent.appendChild(node); }
+    return node;
+}
+
+var app = document.getElementById('app');
+el('div', app);
+var nav = el('div', app);
+el('div', nav); el('div', nav);
+var tabs = el('ul', el('div', nav));
+el('li', tabs, 'All children');
+CHILDREN.forEach(function (child, ind) {
+    var tab = el('div', el('li', el('li', tabs)), child.display_name);
+    tab.style.padding = '10px';
+    tab.onclick = function () { state.child = ind; render(); };
+});
+var main = el('div', app);
+var tiles = el('ul', el('div', main));
+MONTHS.forEach(function (month, ind) {
+    var inner = el('div', el('div', el('div', el('div', el('li', tiles)))));
+    el('span', inner, month[0]);
+    el('span', inner, String(month[1]));
+    inner.onclick = function () { state.month = ind; render(); };
+});
+var content = el('div', main);
+var filters = el('ul', el('div', el('div', content)));
+el('li', filters, 'All').onclick = function () { state.all = true; render(); };
+el('li', filters, 'Photos');
+var panel = el('div', content);
+panel.className = 'well left-panel pull-left';
+var timeline = el('ul', panel);
+
+var modal = el('div', document.body);
+modal.id = 'dr-modal-printable';
+modal.style.display = 'none';
+el('i', el('div', modal), 'x').onclick = function () { modal.style.display = 'none'; };
+var wrapper = el('div', modal);
+wrapper.className = 'modal-overflow-wrapper';
+
+function render() {
+    var month = MONTHS[state.month];
+    var url = '/fake/timeline?child=' + state.child + '&year=' + month[1] + '&month=' + month[2];
+    fetch(url).then(function (resp) { return resp.json(); }).then(function (records) {
+        var list = document.createElement('ul');
+        records.forEach(function (record) {
+            if (record.report && !state.all) { return; }
+            var div = el('div', el('li', list));
+            div.id = record.id;
+            if (record.report) {
+                el('span', div, record.report);
+                el('br', div);
+                el('span', div, record.date);
+                div.onclick = function () { openReport(record.date); };
+            } else {
+                div.setAttribute('style', record.style + ' width: 50px; height: 50px;');
+            }
+        });
+        panel.replaceChild(list, timeline);
+        timeline = list;
+    });
+}
+
+function openReport(date) {
+    var parts = date.split('/');
+    var url = '/fake/report?child=' + state.child + '&year=' + parts[2] + '&month=' + parts[0] + '&day=' + parts[1];
+    fetch(url).then(function (resp) { return resp.text(); }).then(function (html) {
+        wrapper.innerHTML = html;
+        modal.style.display = 'block';
+    });
+}
+
+render();
+</script>
+</body></html>
+'''
+
+
+class FakeTadpoles(object):
+    '''Threaded HTTP server for a FakeAccount.
+
+    latency is added to every request, media_latency additionally to media
+    downloads. failure_rate is the fraction of media requests answered with
+    a 503, truncate_rate the fraction whose body is cut off half way.
+    '''
+    def __init__(self, account, port=0, latency=0.0, media_latency=0.0,
+                 failure_rate=0.0, truncate_rate=0.0, seed=0):
+        self.account = account
+        self.latency = latency
+        self.media_latency = media_latency
+        self.failure_rate = failure_rate
+        self.truncate_rate = truncate_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {'pages': 0, 'api': 0, 'media': 0, 'media_bytes': 0, 'failures': 0}
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self.handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server.server_port
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.stats[name] += amount
+
+    def chance(self, rate):
+        with self.lock:
+            return self.random.random() < rate
+
+    def handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def logged_in(self):
+                return ('%s=1' % SESSION_COOKIE) in (self.headers.get('Cookie') or '')
+
+            def send(self, status, body, content_type='text/html; charset=utf-8', headers=None):
+                if isinstance(body, str):
+                    body = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def send_json(self, data):
+                self.send(200, json.dumps(data), 'application/json')
+
+            def do_POST(self):
+                time.sleep(fake.latency)
+                self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if urlparse(self.path).path != '/login':
+                    return self.send(404, 'not found')
+                self.send(302, '', headers={
+                    'Location': '/parents',
+                    'Set-Cookie': '%s=1; Path=/' % SESSION_COOKIE,
+                })
+
+            def do_GET(self):
+                time.sleep(fake.latency)
+                url = urlparse(self.path)
+                query = {name: values[0] for name, values in parse_qs(url.query).items()}
+                account = fake.account
+                if url.path == '/parents':
+                    fake.count('pages')
+                    if not self.logged_in():
+                        return self.send(200, LOGIN_PAGE)
+                    months = [[MONTHS[month - 1], year, month] for year, month in account.months]
+                    return self.send(200, HOME_PAGE % {
+                        'params': json.dumps(account.app_params()),
+                        'months': json.dumps(months),
+                        'children': json.dumps(account.children),
+                    })
+                if not self.logged_in():
+                    return self.send(401, 'login required')
+                if url.path == '/fake/timeline':
+                    fake.count('pages')
+                    return self.send_json(account.timeline(
+                        int(query['child']), int(query['year']), int(query['month'])))
+                if url.path == '/fake/report':
+                    fake.count('pages')
+                    return self.send(200, account.report_html(
+                        int(query['child']), int(query['year']), int(query['month']), int(query['day'])))
+                if url.path == '/remote/v1/parameters':
+                    fake.count('api')
+                    return self.send_json(account.app_params())
+                if url.path == '/remote/v1/events':
+                    fake.count('api')
+                    return self.send_json({'events': account.events(
+                        int(query['earliest_event_time']), int(query['latest_event_time']))})
+                if url.path == '/remote/v1/obj_attachment':
+                    return self.send_media(query.get('key'))
+                return self.send(404, 'not found')
+
+            def do_HEAD(self):
+                url = urlparse(self.path)
+                query = {name: values[0] for name, values in parse_qs(url.query).items()}
+                key = query.get('key')
+                if url.path != '/remote/v1/obj_attachment' or key not in fake.account.media:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', fake.account.media[key]['type'])
+                self.send_header('Content-Length', str(len(fake.account.payload(key))))
+                self.end_headers()
+
+            def send_media(self, key):
+                time.sleep(fake.media_latency)
+                if key not in fake.account.media:
+                    return self.send(404, 'not found')
+                if fake.chance(fake.failure_rate):
+                    fake.count('failures')
+                    return self.send(503, 'try again')
+                body = fake.account.payload(key)
+                total = len(body)
+                status, headers = 200, {}
+                byte_range = self.headers.get('Range')
+                if byte_range and byte_range.startswith('bytes='):
+                    start = int(byte_range[6:].split('-')[0])
+                    if start >= total:
+                        return self.send(416, '', headers={'Content-Range': 'bytes */%d' % total})
+                    body = body[start:]
+                    status = 206
+                    headers['Content-Range'] = 'bytes %d-%d/%d' % (start, total - 1, total)
+                fake.count('media')
+                if fake.chance(fake.truncate_rate):
+                    fake.count('failures')
+                    self.send_response(status)
+                    self.send_header('Content-Type', fake.account.media[key]['type'])
+                    self.send_header('Content-Length', str(len(body)))
+                    for name, value in headers.items():
+                        self.send_header(name, value)
+                    self.end_headers()
+                    self.wfile.write(body[:len(body) // 2])
+                    self.close_connection = True
+                    fake.count('media_bytes', len(body) // 2)
+                    return
+                fake.count('media_bytes', len(body))
+                self.send(status, body, fake.account.media[key]['type'], headers)
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--children', type=int, default=2)
+    parser.add_argument('--months', type=int, default=3)
+    parser.add_argument('--items', type=int, default=30, help='media items per child and month')
+    parser.add_argument('--size', type=int, default=200, help='media size in KB')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    args = parser.parse_args()
+
+    account = FakeAccount(children=args.children, months=args.months,
+                          items_per_month=args.items, media_size=args.size * 1024)
+    fake = FakeTadpoles(account, port=args.port, latency=args.latency).start()
+    print('Serving %d media items for %d children on %s/parents' % (
+        account.media_count, len(account.children), fake.url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
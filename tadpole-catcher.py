@@ -1,58 +1,780 @@
 """This module downloads all photos/videos from tadpole to a local folder."""
 
 import os
-from os.path import abspath, dirname, join, isfile, isdir
+from os.path import abspath, dirname, join, isfile, isdir, splitext
 import re
 import sys
 import json
 import time
+import argparse
 import pickle
+import queue
+import hashlib
+import html
+import gzip
+import zlib
+import base64
+import mimetypes
 import logging
 import logging.config
-
-from random import randrange
+import threading
+import multiprocessing
+import copy
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, see reflink
+    fcntl = None
+from contextlib import contextmanager
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from urllib.parse import urlparse, urljoin, urlencode, parse_qs, parse_qsl
 from getpass import getpass
 from configparser import ConfigParser
 
 from selenium import webdriver
 from selenium.webdriver.common.action_chains import ActionChains
-from selenium.common.exceptions import NoSuchElementException
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.common.exceptions import NoSuchElementException, TimeoutException
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import HTTPError as TransportError
 
 class DownloadError(Exception):
     """An exception indicating some errors during downloading"""
     pass
 
+class IncompleteDownload(DownloadError):
+    """A transfer stopped early, the partial file can be resumed"""
+    pass
+
 class Image(object):
+    BASE_URL = 'https://www.tadpoles.com'
     url_re = re.compile('\\("([^"]+)')
-    url_search = lambda div: Image.url_re.search(div.get_attribute("style"))
-    def __init__(self, div, date=None):
-        self.div = div
-        # Extract URL from div
-        _url = Image.url_search(div).group(1)
-        _url = _url.replace('thumbnail=true', '')
-        _url = _url.replace('&thumbnail=true', '')
-        self.url = 'https://www.tadpoles.com' + _url
-        # Extract id from div
-        # Shorten _id to avoid OS file length limit
-        # TODO more robust id algorithm
-        _id = div.get_attribute('id').split('-')[1]
-        _id = _id[int(len(_id)/2):]
-        self.id = _id
+    url_search = lambda style: Image.url_re.search(style or '')
+    def __init__(self, url, date=None, old_ids=()):
+        self.url = url
         # Save date (defaults to None)
         self.date = date
-        # Get key (for downloading)
-        _, self.key = self.url.split("key=")
+        # Get key (for downloading), wherever it is in the query
+        self.key = parse_qs(urlparse(self.url).query)['key'][0]
+        # The attachment key is known to every backend, unlike the div id
+        self.id = Image.make_id(self.key)
+        # Ids older versions may have saved it under, see Client.migrate
+        self.old_ids = [Image.legacy_id(self.key)] + list(old_ids)
+        # Location on disk (filled in by the crawler, see Client.locate)
+        self.child_text = None
+        self.year_text = None
+        self.month_text = None
+        self.prefix = None
+    @classmethod
+    def from_record(cls, record, date=None):
+        '''Build from a timeline record, see Client.scrape_timeline'''
+        # Extract URL from the style
+        _url = urlparse(Image.url_search(record['style']).group(1))
+        # The full size image is the same url without the thumbnail parameter
+        query = [(name, value) for name, value in parse_qsl(_url.query) if name != 'thumbnail']
+        url = Image.BASE_URL + _url._replace(query=urlencode(query)).geturl()
+        # Earlier versions named files after the div id
+        _id = record['id'].split('-')[1]
+        return cls(url, date=date, old_ids=[Image.legacy_id(_id), Image.make_id(_id)])
+    @staticmethod
+    def is_image(record):
+        match = Image.url_search(record['style'])
+        return match is not None and 'thumbnail' in match.group(1)
+    @staticmethod
+    def make_id(full_id):
+        # Short enough for any file system, and unlike a slice of the key it
+        # depends on every character of it
+        return hashlib.sha1(full_id.encode('UTF-8')).hexdigest()[:20]
+    @staticmethod
+    def legacy_id(full_id):
+        # Second half of the id, as file names were made up to now
+        return full_id[int(len(full_id)/2):]
     @property
     def date_text(self):
         return "{:02d}".format(self.date if self.date is not None else 1)
+    @property
+    def index_key(self):
+        return Manifest.make_key(self.child_text, self.year_text, self.month_text, self.id)
+    def filename(self, ext):
+        return '{}{}-{}.{}'.format(self.prefix, self.date_text, self.id, ext)
 
 class Report(object):
-    def __init__(self, div):
-        self.div = div
-        self.display_text = div.get_attribute('outerText')
-        date = int(self.display_text.split('\n')[1].split('/')[1])
+    def __init__(self, date, xpath=None, html=None):
+        # Either the xpath of the timeline div to click for the report
+        # modal, or the html itself
+        self.xpath = xpath
+        self.html = html
         self.date_text = "{:02d}".format(date)
+        self.child_text = None
+        self.year_text = None
+        self.month_text = None
+        self.prefix = None
+    @classmethod
+    def from_record(cls, record):
+        '''Build from a timeline record, see Client.scrape_timeline'''
+        date = int(record['outerText'].split('\n')[1].split('/')[1])
+        return cls(date, xpath='(%s)[%d]' % (Client.TIMELINE_XPATH, record['index']))
+    @staticmethod
+    def is_report(record):
+        return (not Image.url_search(record['style'])) and ('report' in record['outerText'])
+    @property
+    def index_key(self):
+        return Manifest.make_key(self.child_text, self.year_text, self.month_text, 'report-' + self.date_text)
+    def filename(self, ext):
+        return '{}{}.{}'.format(self.prefix, self.date_text, ext)
+
+
+class Manifest(object):
+    '''Append-only JSONL index of everything saved under the download dir.
+    Each line records one file keyed by child/year/month/id, so checking
+    whether something was already downloaded is a dict lookup instead of
+    stat calls against the download dir.
+    '''
+    FILE_NAME = '.manifest.jsonl'
+    CONTENT_TYPES = {'jpg': 'image/jpeg', 'png': 'image/png', 'mp4': 'video/mp4', 'html': 'text/html'}
+
+    def __init__(self, root):
+        self.root = abspath(root)
+        self.path = join(self.root, self.FILE_NAME)
+        self.entries = {}
+        # Secondary indexes used for deduplication
+        self.by_checksum = {}
+        self.by_source = {}
+        # Download key per child and month, to find files saved under other names
+        self.by_location = {}
+        self.lock = threading.Lock()
+
+    def _index(self, entry):
+        if entry.get('removed'):
+            self.forget(entry['key'])
+            return
+        # The old entry no longer has a file
+        self.forget(entry.get('moved_from'))
+        self.entries[entry['key']] = entry
+        if entry.get('sha256'):
+            self.by_checksum.setdefault(entry['sha256'], entry)
+        if entry.get('source'):
+            self.by_source.setdefault(entry['source'], entry)
+            self.by_location[(entry['key'].rpartition('/')[0], entry['source'])] = entry
+
+    def _reindex(self, entries):
+        self.entries, self.by_checksum, self.by_source, self.by_location = {}, {}, {}, {}
+        for entry in entries:
+            self._index(entry)
+
+    @staticmethod
+    def make_key(child_text, year_text, month_text, _id):
+        return '/'.join((child_text, year_text, month_text, _id))
+
+    def exists(self):
+        return isfile(self.path)
+
+    def load(self):
+        """Read every entry of the manifest into memory"""
+        self._reindex([])
+        if not self.exists():
+            return
+        with open(self.path, encoding='UTF-8') as manifest_file:
+            for line in manifest_file:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A torn final line from an interrupted run
+                    continue
+                self._index(entry)
+
+    def forget(self, key):
+        """Drop an entry from memory only, everywhere it is indexed"""
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for index, field in ((self.by_checksum, 'sha256'), (self.by_source, 'source')):
+            if entry.get(field) and index.get(entry[field]) is entry:
+                del index[entry[field]]
+        location = (key.rpartition('/')[0], entry.get('source'))
+        if self.by_location.get(location) is entry:
+            del self.by_location[location]
+
+    def find_renamed(self, key, source):
+        """An entry of the same child and month downloaded from source under another key"""
+        entry = self.by_location.get((key.rpartition('/')[0], source))
+        if entry is not None and entry['key'] != key:
+            return entry
+        return None
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def find_blob(self, checksum=None, source=None):
+        """An entry with the same content (by checksum or download key) whose file is still on disk"""
+        entry = None
+        if checksum is not None:
+            entry = self.by_checksum.get(checksum)
+        elif source is not None:
+            entry = self.by_source.get(source)
+        if entry is not None and isfile(join(self.root, entry['path'])):
+            return entry
+        return None
+
+    def add(self, key, filename, content_type, size, checksum, source=None, url=None, moved_from=None):
+        """Record a saved file, both in memory and on disk. moved_from is the
+        key of an entry whose file was renamed to filename.
+        """
+        entry = {
+            'key': key,
+            'path': os.path.relpath(filename, self.root),
+            'type': content_type,
+            'size': size,
+            'sha256': checksum,
+        }
+        if source is not None:
+            entry['source'] = source
+        if url is not None:
+            entry['url'] = url
+        if moved_from is not None:
+            entry['moved_from'] = moved_from
+        self._append(entry)
+        return entry
+
+    def remove(self, key):
+        """Forget an entry, also in later runs, so that it is downloaded again"""
+        self._append({'key': key, 'removed': True})
+
+    def _append(self, entry):
+        with self.lock:
+            self._index(entry)
+            os.makedirs(self.root, exist_ok=True)
+            with open(self.path, 'a', encoding='UTF-8') as manifest_file:
+                manifest_file.write(json.dumps(entry) + '\n')
+
+    def rebuild(self, logger):
+        """Scan the download dir once and rewrite the manifest from what is on disk"""
+        # Download keys and urls cannot be recovered from file names, keep the known ones
+        known = {entry['path']: entry for entry in self.entries.values()}
+        entries = {}
+        for directory, _, files in os.walk(self.root):
+            parts = os.path.relpath(directory, self.root).split(os.sep)
+            if len(parts) != 3:
+                continue
+            child_text, year_text, month_text = parts
+            prefix = 'tadpoles-{}-{}-{}-'.format(child_text, year_text, month_text)
+            for name in files:
+                # Compressed reports are .html.gz
+                stem, _, ext = (name[:-3] if name.endswith('.html.gz') else name).rpartition('.')
+                if not stem.startswith(prefix) or ext not in self.CONTENT_TYPES:
+                    continue
+                rest = stem[len(prefix):]
+                if ext == 'html':
+                    _id = 'report-' + rest
+                else:
+                    _, _, _id = rest.partition('-')
+                    if not _id:
+                        continue
+                filename = join(directory, name)
+                key = self.make_key(child_text, year_text, month_text, _id)
+                entries[key] = {
+                    'key': key,
+                    'path': os.path.relpath(filename, self.root),
+                    'type': self.CONTENT_TYPES[ext],
+                    'size': os.path.getsize(filename),
+                    'sha256': file_checksum(filename),
+                }
+                for field in ('source', 'url'):
+                    if entries[key]['path'] in known and known[entries[key]['path']].get(field):
+                        entries[key][field] = known[entries[key]['path']][field]
+        with self.lock:
+            self._reindex(entries.values())
+            os.makedirs(self.root, exist_ok=True)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='UTF-8') as manifest_file:
+                for entry in entries.values():
+                    manifest_file.write(json.dumps(entry) + '\n')
+            os.replace(tmp_path, self.path)
+        logger.info("Indexed %d files under %s", len(entries), self.root)
+
+
+class SyncState(object):
+    '''High-water marks of previous runs, one per child: the newest month that
+    was crawled and the newest media id seen in it. Months older than the mark
+    have been fully synced and do not need to be crawled again.
+    '''
+    FILE_NAME = '.sync-state.json'
+
+    def __init__(self, root):
+        self.path = join(abspath(root), self.FILE_NAME)
+        self.marks = {}
+
+    def load(self):
+        if isfile(self.path):
+            with open(self.path, encoding='UTF-8') as state_file:
+                self.marks = json.load(state_file)
+
+    def save(self, marks):
+        """Merge the new marks and write them out atomically"""
+        self.marks.update(marks)
+        write_atomically(self.path, json.dumps(self.marks, indent=2, sort_keys=True))
+
+    def get(self, child_text):
+        return self.marks.get(child_text)
+
+    @staticmethod
+    def month_key(year_text, month_text):
+        return (int(year_text), int(month_text))
+
+
+def render_report(event):
+    """Render a daily report event from the API as simple html"""
+    rows = []
+    for entry in event.get('entries', []):
+        cells = ''.join('<td>%s</td>' % html.escape(str(value)) for _, value in sorted(entry.items()))
+        rows.append('<tr>%s</tr>' % cells)
+    title = '%s %s' % (event.get('member_display', ''), event.get('event_date', ''))
+    return '<body><h1>%s</h1><table>%s</table></body>' % (html.escape(title.strip()), ''.join(rows))
+
+
+def parse_content_range(header):
+    """Return (first byte, total size) of a 'bytes first-last/total' header"""
+    match = re.match(r'bytes (\d+)-\d+/(\d+|\*)', header or '')
+    if match is None:
+        return None, None
+    total = match.group(2)
+    return int(match.group(1)), (None if total == '*' else int(total))
+
+
+def stream_to_file(resp, file, digest, chunk_size, throttle=None):
+    '''Copy the body of a streamed response into file, updating digest, and
+    return the number of bytes written. Unless the body is content-encoded,
+    the raw stream is read into one reusable buffer so a large file takes a
+    few hundred writes rather than one per kilobyte. throttle, if given, is
+    called with the size of every chunk (see BandwidthLimiter). A body cut
+    off by the network raises IncompleteDownload; whatever was received is
+    in file up to its current position.
+    '''
+    written = 0
+    if resp.headers.get('content-encoding', 'identity') != 'identity':
+        try:
+            for chunk in resp.iter_content(chunk_size):
+                file.write(chunk)
+                digest.update(chunk)
+                written += len(chunk)
+                if throttle is not None:
+                    throttle(len(chunk))
+        except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError) as exc:
+            raise IncompleteDownload('transfer broke off: %s' % exc)
+        return written
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    try:
+        while True:
+            count = resp.raw.readinto(buf)
+            if not count:
+                break
+            file.write(view[:count])
+            digest.update(view[:count])
+            written += count
+            if throttle is not None:
+                throttle(count)
+    except TransportError as exc:
+        # Reading the raw stream bypasses requests, which would wrap these
+        raise IncompleteDownload('transfer broke off: %s' % exc)
+    finally:
+        view.release()
+    return written
+
+
+def preallocate(file, offset, length):
+    """Reserve disk space for the rest of a download where the OS supports it"""
+    if length <= 0 or not hasattr(os, 'posix_fallocate'):
+        return
+    file.flush()
+    try:
+        os.posix_fallocate(file.fileno(), offset, length)
+    except OSError:
+        # Not supported by this filesystem (e.g. some network shares)
+        pass
+
+
+def check_file(filename, size=None):
+    '''Look for signs of a broken file: missing, empty, not of the expected
+    size, or content that does not match its extension. Returns what is
+    wrong, or None. A plain function so it can run in a process pool.
+    '''
+    try:
+        actual = os.path.getsize(filename)
+    except OSError:
+        return 'missing'
+    if actual == 0:
+        return 'empty'
+    if size is not None and actual != size:
+        return '%d bytes instead of %d' % (actual, size)
+    ext = filename.rpartition('.')[2]
+    try:
+        with open(filename, 'rb') as file:
+            if ext == 'gz':
+                # Compressed report, a truncated one fails to decompress
+                ext, head = 'html', gzip.decompress(file.read())[:16]
+            else:
+                head = file.read(16)
+            if ext == 'png':
+                file.seek(-12, os.SEEK_END)
+                if b'IEND' not in file.read():
+                    return 'png without its end chunk'
+    except (OSError, EOFError, zlib.error) as exc:
+        return 'unreadable (%s)' % exc
+    if ext == 'jpg' and not head.startswith(b'\xff\xd8\xff') \
+            or ext == 'png' and not head.startswith(b'\x89PNG\r\n\x1a\n') \
+            or ext == 'mp4' and head[4:8] != b'ftyp' \
+            or ext == 'html' and not head.lstrip().lower().startswith(b'<html'):
+        return 'not a %s file' % ext
+    return None
+
+
+def make_adapter(info):
+    '''Connection pool for the [DOWNLOADS] settings info. Failed connections
+    and error responses are retried with exponential backoff by the
+    transport; a body that breaks off is resumed by Client.save_image.
+    '''
+    concurrency = info.getint('concurrency', fallback=4)
+    retry = Retry(
+        total=info.getint('max_retries', fallback=5),
+        backoff_factor=info.getfloat('retry_backoff', fallback=1.0),
+        status_forcelist=(429, 500, 502, 503, 504),
+        raise_on_status=False)
+    return HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=info.getint('pool_size', fallback=concurrency),
+        pool_block=True,
+        max_retries=retry)
+
+
+def log_connection_stats(adapter, logger, metrics=None):
+    """Log how many requests each host's pool served and with how many connections"""
+    pools = adapter.poolmanager.pools
+    for key in pools.keys():
+        pool = pools[key]
+        if pool is None:
+            continue
+        logger.info("Connection pool %s: %d requests over %d connections",
+                    pool.host, pool.num_requests, pool.num_connections)
+        if metrics is not None:
+            metrics.count('http_requests', pool.num_requests, host=pool.host)
+            metrics.count('http_connections', pool.num_connections, host=pool.host)
+
+
+def write_atomically(filename, text):
+    """Replace a text file in one step, so readers never see half of it"""
+    directory = dirname(abspath(filename))
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = filename + '.tmp'
+    with open(tmp_path, 'w', encoding='UTF-8') as file:
+        file.write(text)
+    os.replace(tmp_path, filename)
+
+
+def reflink(source, destination):
+    """Copy-on-write clone of source (Linux FICLONE, e.g. on btrfs or XFS)"""
+    FICLONE = 0x40049409
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            os.remove(destination)
+            raise
+
+
+def file_checksum(filename, chunk_size=1024 * 1024):
+    """sha256 of a file on disk"""
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Metrics(object):
+    '''Counters and timing histograms for the hot paths, shared between
+    threads. Metrics may carry labels, e.g.
+    metrics.observe('wait_seconds', 1.5, kind='sleep').
+    '''
+    BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    @staticmethod
+    def _label_text(labels):
+        if not labels:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (key, value) for key, value in labels)
+
+    def count(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def get(self, name, **labels):
+        """Current value of a counter"""
+        with self.lock:
+            return self.counters.get(self._key(name, labels), 0)
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = {'count': 0, 'sum': 0.0, 'max': 0.0,
+                                               'buckets': [0] * len(self.BUCKETS)}
+            hist['count'] += 1
+            hist['sum'] += value
+            hist['max'] = max(hist['max'], value)
+            for ind, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    hist['buckets'][ind] += 1
+                    break
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe the duration of the with block in seconds"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def summary(self):
+        """Everything collected so far as a JSON-friendly dict"""
+        with self.lock:
+            counters = {name + self._label_text(labels): value
+                        for (name, labels), value in sorted(self.counters.items())}
+            histograms = {}
+            for (name, labels), hist in sorted(self.histograms.items()):
+                histograms[name + self._label_text(labels)] = {
+                    'count': hist['count'],
+                    'sum': round(hist['sum'], 3),
+                    'mean': round(hist['sum'] / hist['count'], 3),
+                    'max': round(hist['max'], 3),
+                }
+        return {'counters': counters, 'histograms': histograms}
+
+    def write_json(self, filename):
+        write_atomically(filename, json.dumps(self.summary(), indent=2, sort_keys=True))
+
+    def write_prometheus(self, filename, prefix='tadpoles_'):
+        """Write the metrics in the Prometheus text format (e.g. for node_exporter's textfile collector)"""
+        lines = []
+        with self.lock:
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append('# TYPE %s%s counter' % (prefix, name))
+                    typed.add(name)
+                lines.append('%s%s%s %s' % (prefix, name, self._label_text(labels), value))
+            for (name, labels), hist in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append('# TYPE %s%s histogram' % (prefix, name))
+                    typed.add(name)
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS, hist['buckets']):
+                    cumulative += count
+                    bucket_labels = labels + (('le', bound),)
+                    lines.append('%s%s_bucket%s %d' % (prefix, name, self._label_text(bucket_labels), cumulative))
+                lines.append('%s%s_bucket%s %d' % (prefix, name, self._label_text(labels + (('le', '+Inf'),)), hist['count']))
+                lines.append('%s%s_sum%s %f' % (prefix, name, self._label_text(labels), hist['sum']))
+                lines.append('%s%s_count%s %d' % (prefix, name, self._label_text(labels), hist['count']))
+        write_atomically(filename, '\n'.join(lines) + '\n')
+
+    def log(self, logger):
+        for name, hist in self.summary()['histograms'].items():
+            logger.info("%s: %d times, %.1fs total, %.3fs max", name, hist['count'], hist['sum'], hist['max'])
+        for name, value in self.summary()['counters'].items():
+            logger.info("%s: %s", name, value)
+
+
+def report_metrics(metrics, info, logger):
+    """Log metrics and write them to the files of the [METRICS] settings info"""
+    metrics.log(logger)
+    json_file = info.get('json_file', fallback='logs/metrics.json')
+    if json_file:
+        metrics.write_json(json_file)
+        logger.info("Wrote metrics to %s", json_file)
+    prometheus_file = info.get('prometheus_file', fallback='')
+    if prometheus_file:
+        metrics.write_prometheus(prometheus_file)
+        logger.info("Wrote Prometheus metrics to %s", prometheus_file)
+
+
+class RateLimiter(object):
+    '''Per-host token bucket: up to burst requests at once, refilled at rate
+    requests per second. A rate of 0 disables limiting.
+    '''
+    def __init__(self, rate, burst=1, metrics=None):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.metrics = metrics
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def wait(self, url):
+        """Block until a request to the host of url is allowed"""
+        if self.rate <= 0:
+            return
+        host = urlparse(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            tokens, stamp = self.buckets.get(host, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - stamp) * self.rate) - 1
+            # A negative balance reserves a slot in the future
+            self.buckets[host] = (tokens, now)
+        delay = -tokens / self.rate if tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+        if self.metrics is not None:
+            self.metrics.observe('wait_seconds', delay, kind='rate limit')
+
+
+class TimelineSettled(object):
+    '''WebDriverWait condition: the number of timeline items stopped changing
+    between two polls.
+    '''
+    def __init__(self, selector):
+        self.script = 'return document.querySelectorAll(%s).length' % json.dumps(selector)
+        self.count = None
+
+    def __call__(self, browser):
+        count, self.count = self.count, browser.execute_script(self.script)
+        return count == self.count
+
+
+class BandwidthLimiter(object):
+    '''Token bucket over bytes, shared by every download that should count
+    against the same cap. A limit of 0 disables it.
+    '''
+    def __init__(self, bytes_per_second, metrics=None):
+        self.rate = bytes_per_second
+        self.tokens = bytes_per_second
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+        self.metrics = metrics
+
+    def consume(self, amount):
+        """Account for amount bytes, sleeping if the cap has been exceeded"""
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.stamp) * self.rate) - amount
+            self.stamp = now
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+            if self.metrics is not None:
+                self.metrics.observe('wait_seconds', delay, kind='bandwidth')
+
+
+class DownloadQueue(object):
+    '''Bounded job queue drained by a pool of download threads.
+    The crawler puts jobs while it keeps walking the timeline; put blocks
+    once max_pending jobs are waiting so memory stays bounded.
+
+    Several clients may share one queue (see run_batch): each job carries
+    its handler and owner, and drain waits for one owner's jobs only.
+    Jobs whose handler raised are kept per owner, see failures.
+    '''
+    _STOP = object()
+
+    def __init__(self, handler, concurrency, max_pending, logger):
+        self.handler = handler
+        self.concurrency = max(1, concurrency)
+        self.jobs = queue.Queue(maxsize=max(1, max_pending))
+        self.logger = logger
+        self.threads = []
+        self.cancelled = set()
+        self.pending = {}
+        self.failed = {}
+        self.done = threading.Condition()
+
+    def start(self):
+        for ind in range(self.concurrency):
+            thread = threading.Thread(target=self._work, name='download-%d' % ind, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        self.logger.info("Started %d download workers", self.concurrency)
+
+    def put(self, job, handler=None, owner=None):
+        with self.done:
+            self.pending[owner] = self.pending.get(owner, 0) + 1
+        self.jobs.put((handler or self.handler, job, owner))
+
+    def fail(self, job, owner=None):
+        """Record a job of owner that could not be completed"""
+        with self.done:
+            self.failed.setdefault(owner, []).append(job)
+
+    def failures(self, owner=None):
+        with self.done:
+            return list(self.failed.get(owner, []))
+
+    def cancel(self, owner=None):
+        """Drop the queued jobs of owner instead of running them"""
+        self.cancelled.add(owner)
+        self.logger.info("Cancelling %d queued downloads", self.pending.get(owner, 0))
+
+    def drain(self, owner=None, cancel=False):
+        """Wait until every job of owner is done (or dropped if cancel)"""
+        if cancel:
+            self.cancel(owner)
+        with self.done:
+            self.done.wait_for(lambda: not self.pending.get(owner))
+
+    def close(self, cancel=False):
+        """Wait for queued jobs to finish (or drop them if cancel) and stop the workers"""
+        if cancel:
+            self.cancelled.update(self.pending)
+            self.logger.info("Cancelling %d queued downloads", self.jobs.qsize())
+        for _ in self.threads:
+            self.jobs.put(self._STOP)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def _work(self):
+        while True:
+            item = self.jobs.get()
+            if item is self._STOP:
+                break
+            handler, job, owner = item
+            try:
+                if owner not in self.cancelled:
+                    handler(job)
+            except Exception:
+                self.logger.exception("Error while saving resource")
+                self.fail(job, owner)
+            finally:
+                with self.done:
+                    self.pending[owner] -= 1
+                    self.done.notify_all()
 
 
 class Client:
@@ -62,19 +784,77 @@ class Client:
     ROOT_URL = "http://www.tadpoles.com/parents"
     HOME_URL = "https://www.tadpoles.com/parents"
     CONFIG_FILE_NAME = "conf.json"
-    MIN_SLEEP = 1
-    MAX_SLEEP = 3
+    TIMELINE_XPATH = '//div[@class="well left-panel pull-left"]/ul/li/div'
+    TIMELINE_SELECTOR = 'div[class="well left-panel pull-left"] > ul > li > div'
+    # Reads the records for the items arguments[0] up to arguments[0] +
+    # arguments[1] in one round trip instead of several get_attribute calls
+    # per element; reaching the end scrolls to the last item in case more
+    # are loaded lazily
+    TIMELINE_SCRIPT = '''
+        var divs = document.querySelectorAll('div[class="well left-panel pull-left"] > ul > li > div');
+        var end = Math.min(divs.length, arguments[0] + arguments[1]);
+        var records = [];
+        for (var index = arguments[0]; index < end; index++) {
+            var div = divs[index];
+            records.push({
+                index: index + 1,
+                id: div.id,
+                style: div.getAttribute('style') || '',
+                outerText: div.outerText || ''
+            });
+        }
+        if (end === divs.length && end > 0) {
+            divs[end - 1].scrollIntoView();
+        }
+        return records;
+    '''
+    REPORT_CLOSE_XPATH = '//*[@id="dr-modal-printable"]/div[1]/i'
+    # Read the open report and close it in a single round trip
+    REPORT_SCRIPT = '''
+        var close = document.evaluate(arguments[1], document, null,
+                                      XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+        var text = arguments[0].innerHTML;
+        if (close) {
+            close.click();
+        }
+        return [text, close !== null];
+    '''
+    # Ids made by Image.make_id
+    CURRENT_ID_RE = re.compile('^[0-9a-f]{20}$')
+    # Report images are only fetched from here
+    ASSET_DOMAIN = 'tadpoles.com'
+    ASSET_RE = re.compile(r'''(<img\b[^>]*?\bsrc=)(["'])(.*?)\2''', re.IGNORECASE | re.DOTALL)
     MONTHS = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
 
-    def __init__(self, config, download_reports=True):
+    def __init__(self, config, download_reports=True, full_sync=False, account=None,
+                 adapter=None, downloads=None, rate_limiter=None, bandwidth=None):
+        # In batch mode several clients share one connection pool, download
+        # queue, rate limit and bandwidth cap, each logging under its account name.
+        self.account = account
         self.init_logging()
         self.browser = None
+        self.downloads = downloads
+        self.shared_downloads = downloads is not None
+        self.bandwidth = bandwidth
+        self.rate_limiter = rate_limiter
+        self.session = None
+        self.adapter = adapter
+        self.shared_adapter = adapter is not None
+        self.manifest = None
         self.cookies = None
-        self.req_cookies = None
-        self.__current_month__ = None
-        self.__current_year__ = None
+        self.current_year_text = None
+        self.current_month_text = None
         self.current_child = None
         self.download_reports = download_reports
+        self.full_sync = full_sync
+        # Set on the per-child clients of a parallel crawl
+        self.only_child = None
+        self.stopping = threading.Event()
+        self.metrics = Metrics()
+        self.path_prefixes = {}
+        self.sync_state = None
+        # marks recorded during this run, saved once everything is downloaded
+        self.sync_marks = {}
         self.config = config
         # e.g. {'jan':'01', 'feb':'02', ...}
         self.month_lookup = {month: "{:02d}".format(Client.MONTHS.index(month)+1) for month in Client.MONTHS}
@@ -82,9 +862,262 @@ class Client:
     def config_login_info(self):
         return self.config['AUTHENTICATION']
 
+    @property
+    def cookie_file(self):
+        return self.config_login_info().get('cookie_file', fallback=self.COOKIE_FILE) or self.COOKIE_FILE
+
     def config_requests_info(self):
         return self.config['DOWNLOADS']
 
+    def config_crawler_info(self):
+        return self.config['CRAWLER']
+
+    def config_browser_info(self):
+        return self.config['BROWSER']
+
+    def config_metrics_info(self):
+        return self.config['METRICS']
+
+    def init_manifest(self):
+        """Load the download manifest, seeding it from the download dir on first use"""
+        self.manifest = Manifest(self.config_requests_info()['default_download_dir'])
+        if self.manifest.exists():
+            self.manifest.load()
+            self.logger.info("Loaded %d entries from %s", len(self.manifest), self.manifest.path)
+        else:
+            self.logger.info("No manifest found, indexing %s", self.manifest.root)
+            self.manifest.rebuild(self.logger)
+
+    def init_sync_state(self):
+        """Load the high-water marks used by incremental runs"""
+        self.sync_state = SyncState(self.config_requests_info()['default_download_dir'])
+        if self.full_sync:
+            self.logger.info("Full sync requested, crawling every month")
+            return
+        self.sync_state.load()
+        for child_text, mark in sorted(self.sync_state.marks.items()):
+            self.logger.info("Last synced %s up to %s/%s", child_text, mark['month'], mark['year'])
+
+    def sync_mark(self):
+        """High-water mark of the current child from a previous run (None for full syncs)"""
+        if self.full_sync:
+            return None
+        return self.sync_state.get(self.get_child_name().lower())
+
+    def is_synced(self, year_text, month_text):
+        """True if the current child's month is older than its high-water mark"""
+        mark = self.sync_mark()
+        if mark is None:
+            return False
+        return SyncState.month_key(year_text, month_text) < SyncState.month_key(mark['year'], mark['month'])
+
+    def record_sync_mark(self, year_text, month_text, last_id):
+        """Remember the first (newest) month and media id crawled for the current child"""
+        child_text = self.get_child_name().lower()
+        mark = self.sync_marks.setdefault(child_text, {'year': year_text, 'month': month_text, 'last_id': None})
+        if last_id is not None and mark['last_id'] is None \
+                and (mark['year'], mark['month']) == (year_text, month_text):
+            mark['last_id'] = last_id
+
+    def rebuild_index(self):
+        """Re-scan the download dir and rewrite the manifest"""
+        self.manifest = Manifest(self.config_requests_info()['default_download_dir'])
+        self.manifest.load()
+        self.manifest.rebuild(self.logger)
+        self.migrate_names()
+
+    def migrate_names(self):
+        '''Rename every file saved under an older kind of id whose download
+        key is known, also in months that incremental runs no longer crawl.
+        Files without a known key are renamed when a --full run reaches them.
+        '''
+        renamed = remaining = 0
+        for entry in list(self.manifest.entries.values()):
+            if entry['type'] == 'text/html':
+                continue
+            child_text, year_text, month_text, old_id = entry['key'].split('/')
+            if not entry.get('source'):
+                if not self.CURRENT_ID_RE.match(old_id):
+                    remaining += 1
+                continue
+            new_id = Image.make_id(entry['source'])
+            key = Manifest.make_key(child_text, year_text, month_text, new_id)
+            old_filename = join(self.manifest.root, entry['path'])
+            stem, _, ext = old_filename.rpartition('.')
+            if old_id == new_id or key in self.manifest or not stem.endswith(old_id) \
+                    or not isfile(old_filename):
+                continue
+            filename = stem[:-len(old_id)] + new_id + '.' + ext
+            os.replace(old_filename, filename)
+            self.manifest.add(key, filename, entry['type'], entry['size'], entry['sha256'],
+                              source=entry['source'], url=entry.get('url'), moved_from=entry['key'])
+            renamed += 1
+        if renamed:
+            self.logger.info("Renamed %d files saved under old ids", renamed)
+            self.metrics.count('files_migrated', renamed)
+        if remaining:
+            self.logger.warning("%d files still have names of an older version, "
+                                "run with --full to rename them", remaining)
+
+    def verify(self, check_remote=True):
+        '''Check every file of the manifest and download the broken ones again.
+        Files are checked in a process pool (see check_file); with check_remote
+        the size of every photo and video is also compared with the
+        Content-Length the server reports. Returns the number of broken files
+        and the number of those that could not be downloaded again.
+        '''
+        self.init_manifest()
+        entries = list(self.manifest.entries.values())
+        self.logger.info("Checking %d files", len(entries))
+        broken = {}
+        with self.metrics.timer('verify_seconds', kind='local'):
+            with ProcessPoolExecutor() as pool:
+                paths = [join(self.manifest.root, entry['path']) for entry in entries]
+                sizes = [entry['size'] for entry in entries]
+                for entry, problem in zip(entries, pool.map(check_file, paths, sizes, chunksize=64)):
+                    if problem is not None:
+                        broken[entry['key']] = problem
+
+        media = [entry for entry in entries if entry['type'] != 'text/html' and self.entry_url(entry)]
+        if (check_remote and media) or broken:
+            if self.resume_session() is None:
+                self.cookies = None
+                self.login()
+            self.init_downloads()
+        if check_remote and media:
+            self.logger.info("Comparing the size of %d files with the server", len(media))
+            concurrency = self.config_requests_info().getint('concurrency', fallback=4)
+            with self.metrics.timer('verify_seconds', kind='remote'):
+                with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='verify') as pool:
+                    for entry, size in zip(media, pool.map(self.remote_size, media)):
+                        if size is not None and size != entry['size'] and entry['key'] not in broken:
+                            broken[entry['key']] = 'the server has %d bytes instead of %d' % (size, entry['size'])
+
+        if not broken:
+            self.logger.info("All %d files are fine", len(entries))
+            if self.downloads is not None:
+                self.downloads.close()
+            self.report_metrics()
+            return 0, 0
+        for key, problem in sorted(broken.items()):
+            self.logger.warning("Broken: %s: %s", self.manifest.get(key)['path'], problem)
+            self.metrics.count('verify_broken')
+        # Forget every broken file before queueing any, so that none of them
+        # is used as the source of a deduplicated copy
+        broken_entries = [self.manifest.get(key) for key in broken]
+        for entry in broken_entries:
+            self.manifest.forget(entry['key'])
+        crawl = 0
+        for entry in broken_entries:
+            url = self.entry_url(entry)
+            if entry['type'] == 'text/html' or url is None:
+                # Only a crawl can find it again
+                self.manifest.remove(entry['key'])
+                crawl += 1
+            else:
+                self.downloads.put((entry, url), self.repair, self.account)
+        self.logger.info("Downloading %d broken files again", len(broken_entries) - crawl)
+        self.downloads.close()
+        failed = self.downloads.failures(self.account)
+        for entry, url in failed:
+            self.logger.error("Could not download %s again from %s", entry['path'], url)
+        if failed:
+            self.metrics.count('verify_failed', len(failed))
+        if crawl:
+            self.logger.warning("%d broken files can only be found by crawling again, run with --full", crawl)
+        self.report_metrics()
+        return len(broken_entries), len(failed)
+
+    def entry_url(self, entry):
+        """Where the file of a manifest entry was downloaded from, if known"""
+        if entry.get('url'):
+            return entry['url']
+        if entry.get('source'):
+            # Entries from before urls were recorded only have the key
+            return '%s/remote/v1/obj_attachment?%s' % (Image.BASE_URL, urlencode({'key': entry['source']}))
+        return None
+
+    def remote_size(self, entry):
+        """Content-Length of a manifest entry according to the server, or None"""
+        url = self.entry_url(entry)
+        self.rate_limiter.wait(url)
+        try:
+            resp = self.session.head(url, allow_redirects=True, timeout=self.http_timeout)
+        except requests.RequestException as exc:
+            self.logger.warning("Could not check %s: %s", entry['path'], exc)
+            return None
+        if resp.status_code != 200 or 'content-length' not in resp.headers \
+                or resp.headers.get('content-encoding', 'identity') != 'identity':
+            return None
+        return int(resp.headers['content-length'])
+
+    def repair(self, job):
+        '''Download the file of a broken manifest entry again, in its place'''
+        entry, url = job
+        child_text, year_text, month_text, _ = entry['key'].split('/')
+        prefix = self.path_prefix(child_text, year_text, month_text)
+        old_filename = join(self.manifest.root, entry['path'])
+        img = Image(url, date=int(old_filename[len(prefix):].split('-')[0]))
+        img.child_text, img.year_text, img.month_text, img.prefix = child_text, year_text, month_text, prefix
+        self.save_image(img)
+        repaired = self.manifest.get(img.index_key)
+        if repaired is None:
+            # e.g. the server now sends a type that is not saved
+            raise DownloadError('%r did not return a photo or video' % url)
+        if repaired['path'] != entry['path'] and isfile(old_filename):
+            # Saved under its current name, or it turned out to be of another type
+            os.remove(old_filename)
+        if img.index_key != entry['key']:
+            self.manifest.remove(entry['key'])
+
+    def init_session(self):
+        """Create the shared keep-alive HTTP session used for every download.
+        Retries with exponential backoff are handled by the transport.
+        """
+        if self.adapter is None:
+            self.adapter = make_adapter(self.config_requests_info())
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+
+    def log_connection_stats(self):
+        """Log how many requests each host's pool served and with how many connections"""
+        if self.adapter is None or self.shared_adapter:
+            return
+        log_connection_stats(self.adapter, self.logger, self.metrics)
+
+    def report_metrics(self):
+        """Log the metrics of this run and write them out as configured"""
+        report_metrics(self.metrics, self.config_metrics_info(), self.logger)
+
+    @property
+    def http_timeout(self):
+        """Seconds to wait for a connection or for the next bytes of a response"""
+        return self.config_requests_info().getfloat('timeout', fallback=30)
+
+    @property
+    def dedupe_mode(self):
+        return self.config_requests_info().get('dedupe', fallback='hardlink')
+
+    def init_downloads(self):
+        """Set up the download worker pool and per-host rate limit from settings"""
+        info = self.config_requests_info()
+        if self.rate_limiter is None:
+            self.rate_limiter = RateLimiter(info.getfloat('rate_limit', fallback=2.0),
+                                            burst=info.getint('burst', fallback=1),
+                                            metrics=self.metrics)
+        if self.bandwidth is None:
+            self.bandwidth = BandwidthLimiter(info.getfloat('bandwidth_limit', fallback=0) * 1024,
+                                              metrics=self.metrics)
+        if self.shared_downloads:
+            return
+        self.downloads = DownloadQueue(
+            self.save_image,
+            concurrency=info.getint('concurrency', fallback=4),
+            max_pending=info.getint('queue_size', fallback=100),
+            logger=self.logger)
+        self.downloads.start()
+
     def init_logging(self):
         """Set up logging configuration"""
         # Create logging dir
@@ -94,6 +1127,7 @@ class Client:
 
         logging_config = dict(
             version=1,
+            disable_existing_loggers=False,
             formatters={
                 'f': {
                     'format': '%(asctime)s %(name)-12s %(levelname)-8s %(message)s'}
@@ -119,57 +1153,180 @@ class Client:
         logging.config.dictConfig(logging_config)
 
         self.logger = logging.getLogger('tadpole-catcher')
+        if self.account is not None:
+            self.logger = self.logger.getChild(self.account)
 
-    def __enter__(self):
+    def browser_options(self, profile=None):
+        '''Chrome options from the [BROWSER] settings. Each concurrent browser
+        needs its own user data dir, so profile names a sub-directory.
+        '''
+        info = self.config_browser_info()
+        options = webdriver.ChromeOptions()
+        if info.getboolean('headless', fallback=False):
+            options.add_argument('--headless=new')
+            options.add_argument('--disable-gpu')
+            options.add_argument('--window-size=%s' % info.get('window_size', fallback='1280,1024'))
+        if not info.getboolean('load_images', fallback=False):
+            # Media is fetched over HTTP, the page never needs to render it
+            options.add_argument('--blink-settings=imagesEnabled=false')
+            options.add_experimental_option('prefs', {
+                'profile.managed_default_content_settings.images': 2,
+                'profile.default_content_setting_values.media_stream': 2,
+            })
+        options.add_argument('--mute-audio')
+        options.add_argument('--disable-extensions')
+        options.add_argument('--disable-background-networking')
+        user_data_dir = info.get('user_data_dir', fallback='')
+        if user_data_dir:
+            # Reused between runs so the browser cache stays warm
+            options.add_argument('--user-data-dir=%s' % abspath(join(user_data_dir, profile or 'main')))
+        for argument in info.get('arguments', fallback='').split():
+            options.add_argument(argument)
+        return options
+
+    def new_browser(self, profile=None):
+        """Launch a browser session"""
+        info = self.config_browser_info()
         self.logger.info("Starting browser")
-        self.browser = webdriver.Chrome()
-        self.browser.implicitly_wait(10)
+        capabilities = self.browser_options(profile).to_capabilities()
+        capabilities['pageLoadStrategy'] = info.get('page_load_strategy', fallback='normal')
+        driver_path = info.get('driver_path', fallback='')
+        with self.metrics.timer('browser_start_seconds'):
+            if driver_path:
+                browser = webdriver.Chrome(executable_path=driver_path, desired_capabilities=capabilities)
+            else:
+                browser = webdriver.Chrome(desired_capabilities=capabilities)
+        browser.implicitly_wait(info.getfloat('implicit_wait', fallback=10))
         self.logger.info("Got a browser")
+        return browser
+
+    def __enter__(self):
+        # The browser is started on demand, warm runs may not need one
         return self
 
     def __exit__(self, *args):
-        self.logger.info("Shutting down browser")
-        self.browser.quit()
-
-    def sleep(self, minsleep=None, maxsleep=None):
-        """Sleep a random amount of time bound by the min and max value"""
-        _min = minsleep or self.MIN_SLEEP
-        _max = maxsleep or self.MAX_SLEEP
-        duration = randrange(_min * 100, _max * 100) / 100.0
-        self.logger.info('Sleeping %r', duration)
-        time.sleep(duration)
+        if self.browser is not None:
+            self.logger.info("Shutting down browser")
+            self.browser.quit()
+        if self.session is not None and not self.shared_adapter:
+            # Closing the session closes its adapters, which may be shared
+            self.session.close()
+
+    def wait_for(self, condition, kind, description, required=False):
+        '''Wait until condition holds, at most page_timeout seconds. Returns the
+        condition's value, or None on timeout unless the wait is required.
+        '''
+        info = self.config_crawler_info()
+        wait = WebDriverWait(self.browser, info.getfloat('page_timeout', fallback=15),
+                             poll_frequency=info.getfloat('poll_interval', fallback=0.25))
+        start = time.monotonic()
+        try:
+            return wait.until(condition)
+        except TimeoutException:
+            if required:
+                raise
+            self.logger.info("Timed out waiting for %s", description)
+            return None
+        finally:
+            self.metrics.observe('wait_seconds', time.monotonic() - start, kind=kind)
+
+    def timeline_marker(self):
+        """First timeline item on the page, if any (without an implicit wait)"""
+        return self.browser.execute_script('return document.querySelector(%s)' % json.dumps(self.TIMELINE_SELECTOR))
+
+    def wait_for_timeline(self, marker):
+        '''Wait for the timeline to be replaced after a click: the old first item
+        goes stale and the number of items settles.
+        '''
+        if marker is not None:
+            self.wait_for(EC.staleness_of(marker), 'page', 'the timeline to refresh')
+        self.wait_for(TimelineSettled(self.TIMELINE_SELECTOR), 'page', 'the timeline to settle')
 
     def navigate_url(self, url):
         """Force the browser to go a url"""
         self.logger.info("Navigating to %r", url)
-        self.browser.get(url)
+        with self.metrics.timer('navigate_seconds'):
+            self.browser.get(url)
 
     def load_cookies(self):
         """Load cookies from a previously saved ones"""
         self.logger.info("Loading cookies.")
-        with open(self.COOKIE_FILE, "rb") as file:
+        with open(self.cookie_file, "rb") as file:
             self.cookies = pickle.load(file)
 
+    def resume_session(self):
+        '''Install the cookies of a previous run and check with a cheap API call
+        that the session is still valid. Returns the app params, or None if a
+        full login is needed.
+        '''
+        if not self.config_crawler_info().getboolean('reuse_session', fallback=True) \
+                or not isfile(self.cookie_file):
+            return None
+        try:
+            self.load_cookies()
+        except (OSError, pickle.UnpicklingError, EOFError):
+            self.logger.warning("Could not read %s, logging in again", self.cookie_file)
+            return None
+        self.requestify_cookies()
+        try:
+            params = self.api_get('/remote/v1/parameters')
+        except DownloadError as exc:
+            self.logger.info("Saved session is no longer valid: %s", exc)
+            self.session.cookies.clear()
+            return None
+        self.logger.info("Reusing saved session")
+        return params
+
+    def login(self):
+        """Open the browser and log in, reusing the saved session when it is still valid"""
+        self.browser = self.new_browser()
+        self.navigate_url(self.ROOT_URL)
+        if self.cookies is not None:
+            self.add_cookies_to_browser()
+            self.navigate_url(self.HOME_URL)
+            self.app_params = self.wait_for(lambda browser: browser.execute_script(
+                "return typeof tadpoles !== 'undefined' && tadpoles.appParams"),
+                'login', 'the home page to load')
+            if self.app_params:
+                return
+            self.logger.info("Saved cookies were rejected by the browser")
+            self.navigate_url(self.ROOT_URL)
+        self.do_login()
+        self.dump_cookies()
+        self.add_cookies_to_browser()
+        self.requestify_cookies()
+
+        # Get application parameters
+        self.app_params = self.browser.execute_script("return tadpoles.appParams")
+
     def dump_cookies(self):
         """Save cookies of the existing session to a file"""
         self.logger.info("Dumping cookies.")
         self.cookies = self.browser.get_cookies()
-        with open(self.COOKIE_FILE, "wb") as file:
+        with open(self.cookie_file, "wb") as file:
             pickle.dump(self.browser.get_cookies(), file)
 
     def add_cookies_to_browser(self):
         """Load the saved cookies into the browser"""
         self.logger.info("Adding the cookies to the browser.")
+        host = urlparse(self.browser.current_url).hostname or ''
         for cookie in self.cookies:
-            if self.browser.current_url.strip('/').endswith(cookie['domain']):
+            if host.endswith(cookie['domain'].lstrip('.')):
                 self.browser.add_cookie(cookie)
 
     def requestify_cookies(self):
-        """Transform the cookies to what the request lib requires."""
+        """Transform the cookies to what the request lib requires and install
+        them on the shared session."""
         self.logger.info("Transforming the cookies for requests lib.")
-        self.req_cookies = {}
+        if self.session is None:
+            self.init_session()
         for s_cookie in self.cookies:
-            self.req_cookies[s_cookie["name"]] = s_cookie["value"]
+            # Keep the flags, so a secure cookie is never sent over plain http
+            self.session.cookies.set(s_cookie["name"], s_cookie["value"],
+                                     domain=s_cookie.get("domain", ""),
+                                     path=s_cookie.get("path", "/"),
+                                     secure=s_cookie.get("secure", False),
+                                     rest={'HttpOnly': None} if s_cookie.get("httpOnly") else {})
 
     def switch_windows(self):
         '''Switch to the other window.'''
@@ -182,9 +1339,10 @@ class Client:
     def get_current_child(self):
         return self.get_children_params()[self.current_child_ind]
 
-    def get_child_name(self):
-        display_name = self.get_current_child()['display_name']
-        return display_name.split(' ')[0]
+    def get_child_name(self, child=None):
+        """First name of the current child, or of the child with index child"""
+        params = self.get_current_child() if child is None else self.get_children_params()[child]
+        return params['display_name'].split(' ')[0]
 
     def get_num_children(self):
         return len(self.get_children_params())
@@ -207,6 +1365,12 @@ class Client:
         else:
             self.current_child_ind=0
 
+    def crawl_children(self):
+        """Indexes of the children this client crawls"""
+        if self.only_child is not None:
+            return [self.only_child]
+        return list(range(self.get_num_children()))
+
     def do_login(self):
         """Perform login to tadpole (without Google SSO)"""
         self.logger.info("Navigating to login page.")
@@ -232,8 +1396,10 @@ class Client:
         self.logger.info("Clicking 'submit' button.")
         submit.click()
 
-        self.logger.info("Sleeping 2 seconds.")
-        self.sleep(minsleep=2)
+        self.logger.info("Waiting for the home page.")
+        self.wait_for(lambda browser: browser.execute_script(
+            "return typeof tadpoles !== 'undefined' && !!tadpoles.appParams"),
+            'login', 'the home page to load', required=True)
 
     def iter_monthyear(self):
         '''Yields pairs of xpaths for each year/month tile on the
@@ -249,10 +1415,12 @@ class Client:
             if self.browser.current_url != self.HOME_URL:
                 self.navigate_url(self.HOME_URL)
             # Find the next month and year elements.
-            month = self.find_by_xpath(month_xpath, "any more months")
-            year = self.find_by_xpath(year_xpath, "any more years")
-            self.__current_month__ = month
-            self.__current_year__ = year
+            month = self.find_by_xpath(month_xpath, "any more months", optional=True)
+            year = self.find_by_xpath(year_xpath, "any more years", optional=True)
+            if month is None or year is None:
+                return
+            self.current_year_text = year.text
+            self.current_month_text = self.month_lookup[month.text]
             yield month
             month_index += 1
 
@@ -261,20 +1429,45 @@ class Client:
         '''
         if self.download_reports:
             # Click the "All" button, so reports are included in our iterator
-            self.sleep(1, 3) # Ensure page is loaded
+            all_xpath = '//*[@id="app"]/div[3]/div[2]/div[1]/div[2]/ul/li[1]'
+            self.wait_for(EC.element_to_be_clickable((By.XPATH, all_xpath)), 'page', "the 'All' button")
             self.logger.info("Clicking 'All' button to load reports")
-            all_btn = self.find_by_xpath('//*[@id="app"]/div[3]/div[2]/div[1]/div[2]/ul/li[1]', "'All' button on the Timeline")
+            all_btn = self.find_by_xpath(all_xpath, "'All' button on the Timeline")
             all_btn.click()
 
+        window = max(1, self.config_crawler_info().getint('timeline_window', fallback=200))
+
         # For each month on the dashboard...
         for month in self.iter_monthyear():
+            year_text = self.current_year_text
+            month_text = self.current_month_text
+
+            # Months are listed newest first, so once every child has synced
+            # past this month there is nothing left to crawl.
+            synced = {}
+            for child in self.crawl_children():
+                self.current_child_ind = child
+                synced[child] = self.is_synced(year_text, month_text)
+            if all(synced.values()):
+                self.logger.info("Month %s/%s was already synced. Stopping.", month_text, year_text)
+                return
+
             # Navigate to the next month.
-            month.click()
-            self.logger.info("Getting urls for month: %s", month.text)
-            self.sleep(minsleep=5, maxsleep=7)
+            with self.metrics.timer('month_click_seconds'):
+                marker = self.timeline_marker()
+                month.click()
+                self.logger.info("Getting urls for month: %s", month.text)
+                self.wait_for_timeline(marker)
 
             # For each child...
-            for child in range(self.get_num_children()):
+            for child in self.crawl_children():
+                self.current_child_ind = child
+                if synced[child]:
+                    continue
+                mark = self.sync_mark()
+                at_mark = mark is not None and (mark['year'], mark['month']) == (year_text, month_text)
+                self.record_sync_mark(year_text, month_text, None)
+
                 # Click on child if needed
                 if(self.get_num_children() > 1):
                     self.logger.info("Clicking on %s's page", self.get_child_name())
@@ -282,26 +1475,46 @@ class Client:
                     cur_child_xpath = '//*[@id="app"]/div[2]/div[3]/ul/li[%s]/li/div' % str(self.current_child_ind+2)
                     current_child = self.find_by_xpath(cur_child_xpath, "link to %s's page" % self.get_child_name())
                     # click events are only activated on mouseover
+                    marker = self.timeline_marker()
                     chain = ActionChains(self.browser).move_to_element_with_offset(current_child, 5, 5).click()
                     chain.perform()
-                # Bools to correctly identify reports and images
-                report = lambda div: (not Image.url_search(div)) and ('report' in div.get_attribute('outerText'))
-                image = lambda div: Image.url_search(div) and ('thumbnail' in Image.url_search(div).group(1))
-                elements = self.browser.find_elements_by_xpath('//div[@class="well left-panel pull-left"]/ul/li/div')
+                    self.wait_for_timeline(marker)
 
                 # Collect media files until we see a report
                 # Once we see a report, apply that date to all seen media files
                 # Yield processed media files, and then the report
                 # Deal with edge case where no report is found
                 media_buffer = []
-                for div in elements:
-                    if image(div):
-                        img = Image(div=div)
+                reached_mark = False
+                last_date = None
+                for record in self.iter_timeline(window):
+                    if Image.is_image(record):
+                        if reached_mark:
+                            continue
+                        img = self.locate(Image.from_record(record))
+                        self.record_sync_mark(year_text, month_text, img.id)
+                        # Media is newest first: reaching the last id seen by
+                        # the previous run means everything after it is synced.
+                        # Keep going until the next report to date the buffer.
+                        if at_mark and (mark['last_id'] == img.id or mark['last_id'] in img.old_ids):
+                            self.logger.info("Reached last synced item of %s/%s", month_text, year_text)
+                            reached_mark = True
+                            continue
                         media_buffer.append(img)
-                    elif report(div):
-                        _report = Report(div=div)
+                        if len(media_buffer) >= window:
+                            # No report in sight: date the buffer after the
+                            # last report (media is newest first) to bound it
+                            self.logger.info("No report within %d items, using a provisional date", window)
+                            self.metrics.count('provisional_dates', len(media_buffer))
+                            for img in media_buffer:
+                                img.date = last_date
+                            while len(media_buffer) > 0:
+                                yield media_buffer.pop()
+                    elif Report.is_report(record):
+                        _report = self.locate(Report.from_record(record))
                         # Apply date to all elements in buffer
                         date_text = _report.date_text
+                        last_date = int(date_text)
                         for img in media_buffer:
                             img.date = int(date_text)
                         # For each image/video, pop from buffer and yield
@@ -309,91 +1522,306 @@ class Client:
                             yield media_buffer.pop()
                         # Once images are processed, yield report div
                         yield _report
+                        if reached_mark:
+                            break
                 # Handle edge case where there are media files but no report
                 while len(media_buffer) > 0:
                     yield media_buffer.pop()
 
-                # Goto next child, if possible
-                self.next_child()
+    def scrape_timeline(self, start, count):
+        '''Return {index, id, style, outerText} records for up to count items
+        of the current timeline page from position start, in page order.
+        '''
+        with self.metrics.timer('scrape_seconds'):
+            records = self.browser.execute_script(self.TIMELINE_SCRIPT, start, count) or []
+        self.metrics.count('timeline_items', len(records))
+        return records
+
+    def iter_timeline(self, window):
+        '''Yield the records of the current timeline page, fetched window items
+        at a time so that huge months never have to be held at once. At the
+        end of the page, wait for lazily loaded items before stopping.
+        '''
+        start = 0
+        settled = False
+        while True:
+            records = self.scrape_timeline(start, window)
+            start += len(records)
+            for record in records:
+                yield record
+            if len(records) == window:
+                continue
+            if settled and not records:
+                break
+            self.wait_for(TimelineSettled(self.TIMELINE_SELECTOR), 'page', 'more timeline items')
+            settled = True
+        self.logger.info("Found %d timeline items", start)
 
+    def locate(self, resource):
+        '''Record the child/year/month an Image or Report belongs to, so it can be
+        saved after the crawler has moved on.
+        '''
+        resource.child_text = self.get_child_name().lower()
+        resource.year_text = self.current_year_text
+        resource.month_text = self.current_month_text
+        resource.prefix = self.path_prefix(resource.child_text, resource.year_text, resource.month_text)
+        return resource
+
+    def path_prefix(self, child_text, year_text, month_text):
+        """Start of the path of every file of a child's month, built once per month"""
+        month = (child_text, year_text, month_text)
+        prefix = self.path_prefixes.get(month)
+        if prefix is None:
+            default_download_dir = self.config_requests_info()['default_download_dir']
+            prefix = abspath(join(default_download_dir, child_text, year_text, month_text,
+                                  'tadpoles-{}-{}-{}-'.format(child_text, year_text, month_text)))
+            self.path_prefixes[month] = prefix
+        return prefix
+
+    def api_get(self, path, **params):
+        """GET a JSON document from the Tadpoles API with the session cookies"""
+        api_url = self.config_crawler_info().get('api_url', fallback='https://www.tadpoles.com')
+        url = api_url.rstrip('/') + path
+        try:
+            with self.metrics.timer('api_seconds'):
+                resp = self.session.get(url, params=params, timeout=self.http_timeout)
+            resp.raise_for_status()
+            return resp.json()
+        except (requests.RequestException, ValueError) as exc:
+            raise DownloadError('Error fetching %r: %s' % (url, exc))
+
+    def iter_api_events(self, earliest, latest):
+        """Yield every timeline event between two epoch times, following the paging cursor"""
+        cursor = None
+        while True:
+            params = dict(direction='range', earliest_event_time=earliest,
+                          latest_event_time=latest, num_events=300, client='dashboard')
+            if cursor:
+                params['cursor'] = cursor
+            page = self.api_get('/remote/v1/events', **params)
+            for event in page.get('events', []):
+                yield event
+            cursor = page.get('cursor')
+            if not cursor or not page.get('events'):
+                return
+
+    def iter_api_months(self):
+        """Yield (year_text, month_text, start, end) from the newest month with
+        events back to the oldest, mirroring the month tiles of the web page."""
+        first = datetime.fromtimestamp(self.app_params['first_event_time'])
+        last = datetime.fromtimestamp(self.app_params['last_event_time'])
+        year, month = last.year, last.month
+        while (year, month) >= (first.year, first.month):
+            start = datetime(year, month, 1)
+            end = datetime(year + month // 12, month % 12 + 1, 1)
+            yield str(year), "{:02d}".format(month), int(start.timestamp()), int(end.timestamp())
+            year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+
+    def api_child_index(self, event):
+        """Index of the child an event belongs to"""
+        children = self.get_children_params()
+        if len(children) == 1:
+            return 0
+        for ind, child in enumerate(children):
+            if child.get('key') is not None and child.get('key') == event.get('member'):
+                return ind
+        first_name = (event.get('member_display') or '').split(' ')[0]
+        for ind, child in enumerate(children):
+            if child['display_name'].split(' ')[0] == first_name:
+                return ind
+        return None
+
+    def iter_api_urls(self):
+        '''Same as iter_urls, but enumerates the timeline through the JSON API
+        instead of clicking through the web page.
+        '''
+        api_url = self.config_crawler_info().get('api_url', fallback='https://www.tadpoles.com')
+        for year_text, month_text, start, end in self.iter_api_months():
+            self.current_year_text = year_text
+            self.current_month_text = month_text
 
+            synced = {}
+            for child in range(self.get_num_children()):
+                self.current_child_ind = child
+                synced[child] = self.is_synced(year_text, month_text)
+            if all(synced.values()):
+                self.logger.info("Month %s/%s was already synced. Stopping.", month_text, year_text)
+                return
+
+            self.logger.info("Getting events for month: %s/%s", month_text, year_text)
+            events = {child: [] for child in synced}
+            for event in self.iter_api_events(start, end):
+                child = self.api_child_index(event)
+                if child is None:
+                    self.logger.warning("Skipping event %s of unknown child %s",
+                                        event.get('key'), event.get('member_display'))
+                    continue
+                events[child].append(event)
+
+            for child, child_events in events.items():
+                if synced[child]:
+                    continue
+                self.current_child_ind = child
+                mark = self.sync_mark()
+                at_mark = mark is not None and (mark['year'], mark['month']) == (year_text, month_text)
+                self.record_sync_mark(year_text, month_text, None)
+                # Newest first, like the timeline
+                child_events.sort(key=lambda event: event.get('event_time', 0), reverse=True)
+                for event in child_events:
+                    date = int(event['event_date'].split('-')[2]) if event.get('event_date') \
+                        else datetime.fromtimestamp(event['event_time']).day
+                    if event.get('type') == 'DailyReport':
+                        if self.download_reports:
+                            yield self.locate(Report(date, html=render_report(event)))
+                        continue
+                    reached_mark = False
+                    for attachment in event.get('attachments', []):
+                        key = attachment['key']
+                        url = '%s/remote/v1/obj_attachment?%s' % (api_url.rstrip('/'),
+                                                                  urlencode({'obj': event['key'], 'key': key}))
+                        img = self.locate(Image(url, date=date))
+                        self.record_sync_mark(year_text, month_text, img.id)
+                        if at_mark and (mark['last_id'] == img.id or mark['last_id'] in img.old_ids):
+                            reached_mark = True
+                            break
+                        yield img
+                    if reached_mark:
+                        self.logger.info("Reached last synced item of %s/%s", month_text, year_text)
+                        break
+
+    def report_filename(self, report):
+        """Where a report is saved, according to the report_compress setting"""
+        filename_report = report.filename('html')
+        if self.config_requests_info().getboolean('report_compress', fallback=False):
+            filename_report += '.gz'
+        return filename_report
 
     def save_report(self, report):
-        '''Save a report given the appropriate div.
+        '''Capture a report and queue it for the download workers, which
+        write it out while the crawler moves on to the next item.
         '''
+        filename_report = self.report_filename(report)
 
-        # Make file name
-        child_text = self.get_child_name().lower()
-        year_text = self.__current_year__.text
-        month_text = self.month_lookup[self.__current_month__.text]
-        date_text = report.date_text
-        filename_parts = ['download', child_text, year_text, month_text, 'tadpoles-{}-{}-{}-{}.{}']
-        filename_report = abspath(join(*filename_parts).format(child_text, year_text, month_text, date_text, 'html'))
-
-        # Only download if the file doesn't already exist.
-        if isfile(filename_report):
+        # Only download if the report isn't already in the manifest.
+        if report.index_key in self.manifest:
             self.logger.info("Already downloaded report: %s", filename_report)
+            self.metrics.count('reports_skipped')
             return
 
-        # Make sure the parent dir exists.
-        directory = dirname(filename_report)
-        if not isdir(directory):
-            os.makedirs(directory)
-
         self.logger.info("Downloading report: %s", filename_report)
 
-        div = report.div
-        # Click on div
-        div.click()
-        self.sleep(1, 2) # Wait to load
-        # Extract body
-        body = self.browser.find_element_by_class_name('modal-overflow-wrapper')
-        text = body.get_attribute('innerHTML')
-        # Close pop-up
-        x = self.find_by_xpath('//*[@id="dr-modal-printable"]/div[1]/i', 'Close Popup Button')
-        x.click()
-        # Wait to load
-        self.sleep(1, 2)
-
-        with open(filename_report, 'w', encoding='UTF-8') as report_file:
-            self.logger.info("Saving: %s", filename_report)
-            report_file.write("<html>")
-            report_file.write(text)
-            report_file.write("</html>")
+        if report.html is None:
+            # The API crawler renders reports itself, otherwise open the modal
+            with self.metrics.timer('report_modal_seconds'):
+                report.html = self.read_report_modal(report)
+        self.downloads.put(report, self.write_report, self.account)
 
-        self.logger.info("Finished saving: %s", filename_report)
+    def write_report(self, report):
+        '''Write a captured report, with its images inlined or downloaded
+        next to it if report_assets says so.
+        '''
+        filename_report = self.report_filename(report)
+        info = self.config_requests_info()
+        os.makedirs(dirname(filename_report), exist_ok=True)
+
+        text = report.html
+        assets = info.get('report_assets', fallback='keep')
+        if assets in ('inline', 'download'):
+            text = self.save_report_assets(text, assets, filename_report)
+
+        content = ("<html>" + text + "</html>").encode('UTF-8')
+        if filename_report.endswith('.gz'):
+            content = gzip.compress(content, mtime=0)
+        with open(filename_report, 'wb') as report_file:
+            self.logger.info("Saving: %s", filename_report)
+            report_file.write(content)
+        self.manifest.add(report.index_key, filename_report, 'text/html',
+                          len(content), hashlib.sha256(content).hexdigest())
+        self.metrics.count('reports_saved')
+
+    def save_report_assets(self, text, mode, filename_report):
+        '''Replace the image urls of a report with data: urls (mode inline)
+        or with copies saved in a <report>_files directory (mode download).
+        Images that cannot be fetched keep their original url.
+        '''
+        base = filename_report[:-len('.html.gz')] if filename_report.endswith('.gz') else splitext(filename_report)[0]
+        directory = base + '_files'
+        fetched = {}
+
+        def replace(match):
+            src = html.unescape(match.group(3))
+            if src.startswith('data:'):
+                return match.group(0)
+            if src not in fetched:
+                fetched[src] = self.fetch_report_asset(src, mode, directory, len(fetched))
+            if fetched[src] is None:
+                return match.group(0)
+            return match.group(1) + match.group(2) + html.escape(fetched[src]) + match.group(2)
+
+        return self.ASSET_RE.sub(replace, text)
+
+    def fetch_report_asset(self, src, mode, directory, index):
+        """Fetch one image of a report and return the url to use in its place"""
+        url = urljoin(self.HOME_URL, src)
+        # The session sends the login cookies with every request
+        parsed = urlparse(url)
+        host = parsed.hostname or ''
+        if parsed.scheme != 'https' \
+                or not (host == self.ASSET_DOMAIN or host.endswith('.' + self.ASSET_DOMAIN)):
+            self.logger.warning("Not fetching report image %s, it is not on %s over https", url, self.ASSET_DOMAIN)
+            return None
+        try:
+            self.rate_limiter.wait(url)
+            resp = self.session.get(url, timeout=self.http_timeout)
+            resp.raise_for_status()
+            content_type = resp.headers.get('content-type', 'application/octet-stream').split(';')[0].strip()
+            self.metrics.count('report_assets', type=content_type)
+            if mode == 'inline':
+                return 'data:%s;base64,%s' % (content_type, base64.b64encode(resp.content).decode('ascii'))
+            os.makedirs(directory, exist_ok=True)
+            name = '%d%s' % (index, mimetypes.guess_extension(content_type) or '')
+            with open(join(directory, name), 'wb') as asset_file:
+                asset_file.write(resp.content)
+            return '%s/%s' % (os.path.basename(directory), name)
+        except (requests.RequestException, OSError) as exc:
+            self.logger.warning("Could not fetch report image %s: %s", url, exc)
+            return None
+
+    def read_report_modal(self, report):
+        """Open a report's modal on the timeline and return its html"""
+        # Find the div again (only reports need the element) and click it
+        div = self.find_by_xpath(report.xpath, 'report on the Timeline')
+        div.click()
+        # Wait for the modal, then extract the body and close it
+        body = self.wait_for(EC.visibility_of_element_located((By.CLASS_NAME, 'modal-overflow-wrapper')),
+                             'modal', 'the report to open', required=True)
+        text, closed = self.browser.execute_script(self.REPORT_SCRIPT, body, self.REPORT_CLOSE_XPATH)
+        if not closed:
+            self.find_by_xpath(self.REPORT_CLOSE_XPATH, 'Close Popup Button').click()
+        self.wait_for(EC.invisibility_of_element_located((By.CLASS_NAME, 'modal-overflow-wrapper')),
+                      'modal', 'the report to close')
+        return text
 
     def save_image(self, img):
         '''Save an image locally using requests.
         '''
 
         url = img.url
-        date_text = img.date_text
-        _id = img.id
         key = img.key
-        year_text = self.__current_year__.text
-        month_text = self.month_lookup[self.__current_month__.text]
-        child_text = self.get_child_name().lower()
-        default_download_dir = self.config_requests_info()['default_download_dir']
 
         # Make the local filename.
-        filename_parts = [default_download_dir, child_text, year_text, month_text, 'tadpoles-{}-{}-{}-{}-{}.{}']
-
-        filename_jpg = abspath(join(*filename_parts).format(child_text, year_text, month_text, date_text, _id, 'jpg'))
+        filename_jpg = img.filename('jpg')
         # we might even get a png file even though the mime type is jpeg.
-        filename_png = abspath(join(*filename_parts).format(child_text, year_text, month_text, date_text, _id, 'png'))
+        filename_png = img.filename('png')
         # We don't know if we have a video or image yet so create both name
-        filename_video = abspath(join(*filename_parts).format(child_text, year_text, month_text, date_text, _id, 'mp4'))
-
-        # Only download if the file doesn't already exist.
-        if isfile(filename_jpg):
-            self.logger.info("Already downloaded image: %s", filename_jpg)
-            return
-        if isfile(filename_video):
-            self.logger.info("Already downloaded video: %s", filename_video)
-            return
-        if isfile(filename_png):
-            self.logger.info("Already downloaded png file: %s", filename_png)
+        filename_video = img.filename('mp4')
+
+        # Only download if the manifest doesn't know about it yet, under
+        # either its current or its legacy name.
+        entry = self.manifest.get(img.index_key) or self.migrate(img)
+        if entry is not None:
+            self.logger.info("Already downloaded %s: %s", entry['type'], entry['path'])
+            self.metrics.count('downloads_skipped')
             return
 
         self.logger.info("Downloading from: %s", url)
@@ -401,86 +1829,318 @@ class Client:
         # Make sure the parent dir exists.
         directory = dirname(filename_jpg)
         if not isdir(directory):
-            os.makedirs(directory)
+            os.makedirs(directory, exist_ok=True)
 
-        # Sleep to avoid bombarding the server
-        self.sleep(1, 3)
+        filenames = {'image/jpeg': filename_jpg, 'image/png': filename_png, 'video/mp4': filename_video}
 
-        # Download it with requests.
-        max_retries = int(self.config_requests_info()['max_retries'])
-        retries = 0
-        while retries < max_retries:
-            resp = requests.get(url, cookies=self.req_cookies, stream=True)
-            if resp.status_code == 200:
-                file = None
-                try:
-                    content_type = resp.headers['content-type']
-
-                    self.logger.info("Content Type: %s.", content_type)
-
-                    if content_type == 'image/jpeg':
-                        filename = filename_jpg
-                    elif content_type == 'image/png':
-                        filename = filename_png
-                    elif content_type == 'video/mp4':
-                        filename = filename_video
-                    else:
-                        self.logger.warning("Unsupported content type: %s", content_type)
-                        return
-
-                    for chunk in resp.iter_content(1024):
-                        if file is None:
-                            self.logger.info("Saving: %s", filename)
-                            file = open(filename, 'wb')
-                        file.write(chunk)
-
-                    self.logger.info("Finished saving %s", filename)
-                finally:
-                    if file is not None:
-                        file.close()
+        # The same photo is often on several children's timelines: link to the
+        # copy we already have instead of downloading it again.
+        blob = self.manifest.find_blob(source=key) if self.dedupe_mode != 'off' else None
+        if blob is not None and self.link_blob(blob, filenames[blob['type']]):
+            self.manifest.add(img.index_key, filenames[blob['type']], blob['type'], blob['size'], blob['sha256'],
+                              source=key, url=url)
+            self.metrics.count('downloads_deduped')
+            return
+
+        # Download into a .part file, resuming it with Range requests if the
+        # transfer breaks, and only give it its real name once complete.
+        # Connection errors and error responses were already retried by the
+        # transport (see make_adapter), only broken bodies are retried here.
+        filename_part = img.filename('part')
+        max_retries = self.config_requests_info().getint('max_retries', fallback=5)
+        for attempt in range(max_retries):
+            # Throttle to avoid bombarding the server
+            self.rate_limiter.wait(url)
+            try:
+                with self.metrics.timer('download_seconds'):
+                    result = self.download_part(url, filename_part)
+                break
+            except IncompleteDownload as exc:
+                self.logger.warning("Download of %r interrupted (%s). Resuming.", url, exc)
+                self.metrics.count('download_resumes')
+            except requests.RequestException as exc:
+                raise DownloadError('Error downloading %r: %s' % (url, exc))
+        else:
+            raise DownloadError('Giving up on %r after %d attempts' % (url, max_retries))
+        if result is None:
+            return
+        content_type, size, checksum = result
+
+        # we might even get a png file even though the mime type is jpeg.
+        filename = filenames[content_type]
+        blob = self.manifest.find_blob(checksum=checksum) if self.dedupe_mode != 'off' else None
+        if blob is not None and self.link_blob(blob, filename):
+            # Same content under another key, keep only one copy on disk
+            os.remove(filename_part)
+        else:
+            os.replace(filename_part, filename)
+        self.manifest.add(img.index_key, filename, content_type, size, checksum, source=key, url=url)
+        self.metrics.count('downloads', type=content_type)
+        self.logger.info("Finished saving %s", filename)
+
+    def migrate(self, img):
+        '''Rename a file that an older version or the other backend saved for
+        img to its current name. It is found by download key, or for entries
+        without one, by the old ids of img. An old entry downloaded from a
+        different key belongs to another photo whose id happened to share
+        the same second half, so it is left alone and img is downloaded.
+        '''
+        entry = self.manifest.find_renamed(img.index_key, img.key)
+        for old_id in img.old_ids:
+            if entry is not None:
                 break
+            entry = self.manifest.get(Manifest.make_key(img.child_text, img.year_text, img.month_text, old_id))
+            if entry is not None and entry.get('source', img.key) != img.key:
+                entry = None
+        if entry is None:
+            return None
+        legacy_key = entry['key']
+        old_filename = join(self.manifest.root, entry['path'])
+        if not isfile(old_filename):
+            return None
+        filename = img.filename(old_filename.rpartition('.')[2])
+        os.replace(old_filename, filename)
+        self.logger.info("Renamed %s to %s", entry['path'], filename)
+        self.metrics.count('files_migrated')
+        return self.manifest.add(img.index_key, filename, entry['type'], entry['size'], entry['sha256'],
+                                 source=img.key, url=img.url, moved_from=legacy_key)
+
+    def link_blob(self, blob, filename):
+        '''Make filename share the data of an already saved file (hardlink or
+        reflink, per the dedupe setting). Returns False if the filesystem
+        cannot do it, in which case the caller keeps its own copy.
+        '''
+        source = join(self.manifest.root, blob['path'])
+        if abspath(source) == abspath(filename):
+            return False
+        try:
+            # Without fcntl (Windows) there are no reflinks, hardlink instead
+            if self.dedupe_mode == 'reflink' and fcntl is not None:
+                reflink(source, filename)
             else:
-                msg = 'Error downloading %r. Retrying. Response:'+str(resp)
-                retries += 1
-                self.logger.warning(msg, url)
-                self.sleep(1, 5)
+                os.link(source, filename)
+        except OSError as exc:
+            self.logger.info("Could not %s %s to %s: %s", self.dedupe_mode, source, filename, exc)
+            return False
+        self.logger.info("Linked duplicate %s to %s", filename, source)
+        # Counted in the metrics, which the clients of a parallel crawl share
+        self.metrics.count('deduped_files')
+        self.metrics.count('deduped_bytes', blob['size'])
+        return True
+
+    def download_part(self, url, filename_part):
+        '''Fetch url into filename_part, continuing from whatever a previous
+        attempt left in it. Returns (content type, size, sha256) once the file is
+        complete, or None for unsupported content.
+        '''
+        offset = os.path.getsize(filename_part) if isfile(filename_part) else 0
+        headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+        with self.session.get(url, stream=True, headers=headers, timeout=self.http_timeout) as resp:
+            if resp.status_code == 416:
+                # The partial file does not match what the server has any more
+                os.remove(filename_part)
+                raise IncompleteDownload('range not satisfiable, starting over')
+            if resp.status_code == 206:
+                start, total = parse_content_range(resp.headers.get('content-range'))
+                if start != offset:
+                    os.remove(filename_part)
+                    raise IncompleteDownload('server resumed at byte %s instead of %d' % (start, offset))
+                self.logger.info("Resuming %s at byte %d", filename_part, offset)
+            elif resp.status_code == 200:
+                # Full content, the server ignored or did not get a Range
+                offset = 0
+                total = resp.headers.get('content-length')
+            else:
+                raise DownloadError('Error downloading %r. Response: %s' % (url, resp))
+            if total is not None:
+                total = int(total)
+            if resp.headers.get('content-encoding', 'identity') != 'identity':
+                # Lengths are of the encoded body, not of what gets written
+                total = None
+
+            content_type = resp.headers['content-type']
+
+            self.logger.info("Content Type: %s.", content_type)
+
+            if content_type not in ('image/jpeg', 'image/png', 'video/mp4'):
+                self.logger.warning("Unsupported content type: %s", content_type)
+                if isfile(filename_part):
+                    os.remove(filename_part)
+                return None
+
+            digest = hashlib.sha256()
+            if offset:
+                with open(filename_part, 'rb') as file:
+                    for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                        digest.update(chunk)
+            size = offset
+            info = self.config_requests_info()
+            self.logger.info("Saving: %s", filename_part)
+            with open(filename_part, 'r+b' if offset else 'wb') as file:
+                file.seek(offset)
+                if total is not None and info.getboolean('preallocate', fallback=True):
+                    preallocate(file, offset, total - offset)
+                try:
+                    stream_to_file(resp, file, digest, info.getint('chunk_size', fallback=1024 * 1024),
+                                   throttle=self.bandwidth.consume)
+                finally:
+                    # Drop whatever was preallocated but not written, so the
+                    # size of the .part file is where a resume starts.
+                    written = file.tell() - offset
+                    file.truncate(offset + written)
+                    self.metrics.count('download_bytes', written)
+            size += written
+
+        if total is not None and size != total:
+            raise IncompleteDownload('got %d of %d bytes' % (size, total))
+        return content_type, size, digest.hexdigest()
 
     def download_images(self):
         '''Login to tadpoles.com and download all user's images.
         '''
 
-        self.navigate_url(self.ROOT_URL)
-        self.do_login()
-        self.dump_cookies()
-        self.add_cookies_to_browser()
-        self.requestify_cookies()
+        backend = self.config_crawler_info().get('backend', fallback='browser')
+        browsers = self.config_crawler_info().getint('browsers', fallback=1)
 
-        # Get application parameters
-        self.app_params = self.browser.execute_script("return tadpoles.appParams")
+        app_params = self.resume_session()
+        if app_params is not None and backend == 'api':
+            # Everything goes over HTTP, no need for a browser at all
+            self.app_params = app_params
+        else:
+            if app_params is None:
+                self.cookies = None
+            self.login()
         self.logger.info("Loaded Tadpoles parameters")
 
         # start off with child 0 (if more than one exists)
         self.current_child_ind = 0
 
-        for response in self.iter_urls():
+        if self.manifest is None:
+            self.init_manifest()
+        self.migrate_names()
+        self.init_sync_state()
+
+        # Media and captured reports are written by the download workers
+        # while the crawler keeps going.
+        self.init_downloads()
+
+        interrupted = False
+        try:
+            if backend == 'api':
+                self.logger.info("Enumerating the timeline through the API")
+                self.process(self.iter_api_urls())
+            elif browsers > 1 and self.get_num_children() > 1:
+                self.crawl_in_parallel(browsers)
+            else:
+                self.process(self.iter_urls())
+        except KeyboardInterrupt:
+            interrupted = True
+            self.stopping.set()
+            self.logger.info("Download interrupted by user")
+        finally:
+            # In batch runs the interrupt reaches the main thread, which
+            # only sets stopping
+            interrupted = interrupted or self.stopping.is_set()
+            self.logger.info("Waiting for queued downloads to finish")
+            if self.shared_downloads:
+                self.downloads.drain(self.account, cancel=interrupted)
+            else:
+                self.downloads.close(cancel=interrupted)
+            self.log_connection_stats()
+            self.report_metrics()
+            if self.metrics.get('deduped_files'):
+                self.logger.info("Linked %d duplicate files, saving %.1f MB",
+                                 self.metrics.get('deduped_files'),
+                                 self.metrics.get('deduped_bytes') / 1024 / 1024)
+        # Keep the previous mark of a child with failed items, so that the next
+        # incremental run crawls them again
+        failed = {}
+        for job in self.downloads.failures(self.account):
+            failed[job.child_text] = failed.get(job.child_text, 0) + 1
+        for child_text, count in sorted(failed.items()):
+            self.logger.warning("%d items of %s could not be saved, not advancing its sync mark",
+                                count, child_text)
+            self.sync_marks.pop(child_text, None)
+        # Stopping may also have been set while waiting for the downloads
+        if not interrupted and not self.stopping.is_set() and self.sync_marks:
+            self.sync_state.save(self.sync_marks)
+            self.logger.info("Saved sync state to %s", self.sync_state.path)
+
+    def process(self, responses):
+        '''Queue media for the download workers. Reports are captured with
+        this client's browser first and then queued for writing.
+        '''
+        for response in responses:
+            if self.stopping.is_set():
+                return
             try:
                 if isinstance(response, Image):
-                    self.save_image(response)
+                    self.downloads.put(response, self.save_image, self.account)
                 elif isinstance(response, Report):
                     self.save_report(response)
             except DownloadError:
                 self.logger.exception("Error while saving resource")
-            except (KeyboardInterrupt):
-                self.logger.info("Download interrupted by user")
+                self.downloads.fail(response, self.account)
 
-    def find_by_xpath(self, selector, name='element', form=None):
-        '''Find element by xpath, but catch NoSuchElementException to log which XPath is faulty
+    def spawn(self, child):
+        '''Make a client with its own browser that crawls only one child. It
+        shares the session, manifest, sync marks and download queue with this one.
+        '''
+        worker = copy.copy(self)
+        worker.only_child = child
+        worker.current_child_ind = child
+        worker.logger = self.logger.getChild(self.get_child_name(child).lower())
+        worker.browser = worker.new_browser(profile='child-%d' % child)
+        # Reuse the login of this session instead of logging in again
+        worker.navigate_url(self.ROOT_URL)
+        worker.add_cookies_to_browser()
+        worker.navigate_url(self.HOME_URL)
+        return worker
+
+    def crawl_child(self, child):
+        """Crawl one child's timeline in a browser of its own"""
+        worker = self.spawn(child)
+        try:
+            worker.process(worker.iter_urls())
+        finally:
+            worker.logger.info("Shutting down browser")
+            worker.browser.quit()
+
+    def crawl_in_parallel(self, browsers):
+        """Crawl every child at the same time, one browser per child"""
+        children = self.crawl_children()
+        self.logger.info("Crawling %d children with up to %d browsers", len(children), browsers)
+        with ThreadPoolExecutor(max_workers=browsers) as pool:
+            futures = {pool.submit(self.crawl_child, child): child for child in children}
+            try:
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except (Exception, SystemExit):
+                        # find_by_xpath exits when the page is not as expected,
+                        # which must not stop the other children's crawls
+                        child_text = self.get_child_name(futures[future]).lower()
+                        self.logger.exception("Error while crawling %s, not advancing its sync mark",
+                                              child_text)
+                        self.metrics.count('crawl_failures')
+                        # The months the crawl did not reach still need a crawl
+                        self.sync_marks.pop(child_text, None)
+            except KeyboardInterrupt:
+                self.stopping.set()
+                raise
+
+    def find_by_xpath(self, selector, name='element', form=None, optional=False):
+        '''Find element by xpath, but catch NoSuchElementException to log which XPath is faulty.
+        Optional elements return None instead of stopping the script.
         '''
         if form==None:
             form = self.browser
         try:
             el = form.find_element_by_xpath(selector)
         except NoSuchElementException:
+            if optional:
+                self.logger.info("Could not find %s using XPath %s.", name, selector)
+                return None
             self.logger.info("Could not find %s using XPath %s. Stopping.", name, selector)
             sys.exit(0)
         return el
@@ -495,6 +2155,38 @@ def create_config_file(file_name):
     cfg['DOWNLOADS'] = {}
     cfg['DOWNLOADS']['max_retries'] = '5'
     cfg['DOWNLOADS']['default_download_dir'] = 'download'
+    cfg['DOWNLOADS']['concurrency'] = '4'
+    cfg['DOWNLOADS']['rate_limit'] = '2'
+    cfg['DOWNLOADS']['burst'] = '1'
+    cfg['DOWNLOADS']['queue_size'] = '100'
+    cfg['DOWNLOADS']['pool_size'] = '4'
+    cfg['DOWNLOADS']['chunk_size'] = '1048576'
+    cfg['DOWNLOADS']['preallocate'] = 'yes'
+    cfg['DOWNLOADS']['dedupe'] = 'hardlink'
+    cfg['DOWNLOADS']['bandwidth_limit'] = '0'
+    cfg['DOWNLOADS']['report_compress'] = 'no'
+    cfg['DOWNLOADS']['report_assets'] = 'keep'
+    cfg['DOWNLOADS']['retry_backoff'] = '1'
+    cfg['DOWNLOADS']['timeout'] = '30'
+    cfg['CRAWLER'] = {}
+    cfg['CRAWLER']['backend'] = 'browser'
+    cfg['CRAWLER']['api_url'] = 'https://www.tadpoles.com'
+    cfg['CRAWLER']['browsers'] = '1'
+    cfg['CRAWLER']['reuse_session'] = 'yes'
+    cfg['CRAWLER']['page_timeout'] = '15'
+    cfg['CRAWLER']['poll_interval'] = '0.25'
+    cfg['CRAWLER']['timeline_window'] = '200'
+    cfg['BROWSER'] = {}
+    cfg['BROWSER']['headless'] = 'no'
+    cfg['BROWSER']['load_images'] = 'no'
+    cfg['BROWSER']['user_data_dir'] = ''
+    cfg['BROWSER']['page_load_strategy'] = 'normal'
+    cfg['BROWSER']['implicit_wait'] = '10'
+    cfg['BROWSER']['driver_path'] = ''
+    cfg['BROWSER']['arguments'] = ''
+    cfg['METRICS'] = {}
+    cfg['METRICS']['json_file'] = 'logs/metrics.json'
+    cfg['METRICS']['prometheus_file'] = ''
     with open(file_name, 'w') as cfg_file:
         cfg.write(cfg_file)
     print("New configuration file generated!\n")
@@ -504,9 +2196,119 @@ def create_config_file(file_name):
 def read_config_file(file_name):
     cfg = ConfigParser()
     cfg.read(file_name)
+    # settings files from older versions lack the newer sections
+    for section in ('DOWNLOADS', 'CRAWLER', 'BROWSER', 'METRICS'):
+        if not cfg.has_section(section):
+            cfg.add_section(section)
+    return cfg
+
+def account_config(config, name, account):
+    '''Copy of config with the [account:name] settings applied: credentials
+    and cookie file, download dir, and per-account metrics and browser profile
+    so that accounts never write to each other's files.
+    '''
+    cfg = ConfigParser()
+    cfg.read_dict(config)
+    if not cfg.has_section('AUTHENTICATION'):
+        cfg.add_section('AUTHENTICATION')
+    cfg['AUTHENTICATION']['username'] = account.get('username', fallback='')
+    cfg['AUTHENTICATION']['password'] = account.get('password', fallback='')
+    cfg['AUTHENTICATION']['cookie_file'] = account.get('cookie_file', fallback='cookies-%s.pkl' % name)
+    cfg['DOWNLOADS']['default_download_dir'] = account.get(
+        'download_dir', fallback=join(config['DOWNLOADS'].get('default_download_dir', fallback='download'), name))
+    # e.g. logs/metrics.json becomes logs/metrics-<name>.json
+    for option, fallback in (('json_file', 'logs/metrics.json'), ('prometheus_file', '')):
+        filename = cfg['METRICS'].get(option, fallback=fallback)
+        if filename:
+            root, ext = splitext(filename)
+            cfg['METRICS'][option] = '%s-%s%s' % (root, name, ext)
+    if cfg['BROWSER'].get('user_data_dir', fallback=''):
+        cfg['BROWSER']['user_data_dir'] = join(cfg['BROWSER']['user_data_dir'], name)
     return cfg
 
+
+def run_batch(config, batch_file, full_sync=False):
+    '''Sync every [account:<name>] of batch_file. Up to [BATCH] concurrency
+    accounts run at once; they share one connection pool, one download queue
+    of [BATCH] workers, the per-host rate limit and one [BATCH] bandwidth_limit
+    (KB/s, 0 for none), so adding accounts does not multiply the load on Tadpoles.
+    '''
+    batch = ConfigParser()
+    if not batch.read(batch_file):
+        raise SystemExit("Could not read %s" % batch_file)
+    info = batch['BATCH'] if batch.has_section('BATCH') else batch[batch.default_section]
+    names = [section.split(':', 1)[1] for section in batch.sections() if section.startswith('account:')]
+    if not names:
+        raise SystemExit("No [account:<name>] sections in %s" % batch_file)
+
+    logger = logging.getLogger('tadpole-catcher')
+    # What the accounts share is measured for the whole batch
+    metrics = Metrics()
+    adapter = make_adapter(config['DOWNLOADS'])
+    rate_limiter = RateLimiter(config['DOWNLOADS'].getfloat('rate_limit', fallback=2.0),
+                               burst=config['DOWNLOADS'].getint('burst', fallback=1),
+                               metrics=metrics)
+    bandwidth = BandwidthLimiter(info.getfloat('bandwidth_limit', fallback=0) * 1024, metrics=metrics)
+    downloads = DownloadQueue(None,
+                              info.getint('workers', fallback=config['DOWNLOADS'].getint('concurrency', fallback=4)),
+                              config['DOWNLOADS'].getint('queue_size', fallback=100),
+                              logger)
+    clients = [Client(account_config(config, name, batch['account:' + name]), full_sync=full_sync,
+                      account=name, adapter=adapter, downloads=downloads,
+                      rate_limiter=rate_limiter, bandwidth=bandwidth)
+               for name in names]
+
+    def sync(client):
+        with client:
+            client.download_images()
+
+    logger.info("Syncing %d accounts, %d at a time", len(clients), info.getint('concurrency', fallback=2))
+    downloads.start()
+    executor = ThreadPoolExecutor(max_workers=max(1, info.getint('concurrency', fallback=2)),
+                                  thread_name_prefix='account')
+    futures = dict((executor.submit(sync, client), client) for client in clients)
+    failed = []
+    try:
+        for future in as_completed(futures):
+            if future.exception() is not None:
+                client = futures[future]
+                client.logger.error("Sync failed: %s", future.exception())
+                failed.append(client.account)
+    except KeyboardInterrupt:
+        logger.info("Batch interrupted by user")
+        # Let every account stop crawling and drop its queued jobs; the
+        # workers keep running until then so that no put or drain blocks
+        for client in clients:
+            client.stopping.set()
+            downloads.cancel(client.account)
+        executor.shutdown(wait=True, cancel_futures=True)
+        downloads.close()
+        raise
+    executor.shutdown()
+    downloads.close()
+    log_connection_stats(adapter, logger, metrics)
+    report_metrics(metrics, config['METRICS'], logger)
+    if failed:
+        logger.warning("Accounts that failed: %s", ', '.join(failed))
+    return failed
+
+
 if __name__ == "__main__":
+    # The process pool of --verify re-runs the frozen exe in its workers
+    multiprocessing.freeze_support()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rebuild-index', action='store_true',
+                        help='scan the download dir to rebuild the manifest, then exit')
+    parser.add_argument('--full', action='store_true',
+                        help='crawl every month instead of stopping at the last synced one')
+    parser.add_argument('--verify', action='store_true',
+                        help='check every downloaded file and download broken ones again, then exit')
+    parser.add_argument('--offline', action='store_true',
+                        help='with --verify, do not compare file sizes with the server')
+    parser.add_argument('--batch', metavar='ACCOUNTS_INI',
+                        help='sync every account listed in this file (see README)')
+    args = parser.parse_args()
+
     settings = 'settings.ini'
     config = None
     if isfile(settings):
@@ -516,5 +2318,17 @@ if __name__ == "__main__":
         input("Press any key to exit.")
         exit()
 
-    with Client(config) as client:
+    if args.rebuild_index:
+        Client(config).rebuild_index()
+        exit()
+
+    if args.verify:
+        with Client(config) as client:
+            broken, failed = client.verify(check_remote=not args.offline)
+            exit(2 if failed else 1 if broken else 0)
+
+    if args.batch:
+        exit(1 if run_batch(config, args.batch, full_sync=args.full) else 0)
+
+    with Client(config, full_sync=args.full) as client:
         client.download_images()
@@ -0,0 +1,711 @@
+"""Tests of the client, mostly against the local fake Tadpoles server of
+benchmarks/fake_tadpoles.py (no browser needed).
+
+    python -m unittest discover tests
+"""
+
+import os
+import copy
+import sys
+import gzip
+import hashlib
+import json
+import logging
+import pickle
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import unittest
+from configparser import ConfigParser
+from os.path import abspath, dirname, join
+
+import requests
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'benchmarks'))
+
+from common import load_catcher
+from fake_tadpoles import FakeAccount, FakeTadpoles, SESSION_COOKIE
+
+catcher = load_catcher()
+
+
+def setUpModule():
+    # The client logs every request at debug level
+    logging.disable(logging.CRITICAL)
+
+
+def tearDownModule():
+    logging.disable(logging.NOTSET)
+
+
+def make_config(url='http://127.0.0.1:9'):
+    """Settings for the api backend against the fake server at url"""
+    cfg = ConfigParser()
+    cfg['AUTHENTICATION'] = {'username': '', 'password': ''}
+    cfg['DOWNLOADS'] = {'default_download_dir': 'download', 'rate_limit': '0', 'max_retries': '3',
+                        'retry_backoff': '0', 'timeout': '5'}
+    cfg['CRAWLER'] = {'backend': 'api', 'api_url': url}
+    cfg['BROWSER'] = {}
+    cfg['METRICS'] = {'json_file': '', 'prometheus_file': ''}
+    return cfg
+
+
+class TempDirTest(unittest.TestCase):
+    '''Runs every test in a fresh working directory (the client writes its
+    logs and cookies relative to it).
+    '''
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.workdir = tempfile.mkdtemp(prefix='tadpole-test-')
+        os.chdir(self.workdir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.workdir)
+
+    def write(self, name, content):
+        path = join(self.workdir, name)
+        os.makedirs(dirname(path), exist_ok=True)
+        with open(path, 'wb') as file:
+            file.write(content)
+        return path
+
+
+class ParseContentRangeTest(unittest.TestCase):
+    def test_range(self):
+        self.assertEqual(catcher.parse_content_range('bytes 100-199/200'), (100, 200))
+
+    def test_unknown_total(self):
+        self.assertEqual(catcher.parse_content_range('bytes 100-199/*'), (100, None))
+
+    def test_missing(self):
+        self.assertEqual(catcher.parse_content_range(None), (None, None))
+
+
+class RateLimiterTest(unittest.TestCase):
+    def test_requests_are_spaced_per_host(self):
+        metrics = catcher.Metrics()
+        limiter = catcher.RateLimiter(20, metrics=metrics)
+        start = time.monotonic()
+        for _ in range(3):
+            limiter.wait('https://www.tadpoles.com/a')
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+        # Another host has a bucket of its own
+        start = time.monotonic()
+        limiter.wait('https://s3.amazonaws.com/b')
+        self.assertLess(time.monotonic() - start, 0.04)
+        self.assertEqual(metrics.summary()['histograms']['wait_seconds{kind="rate limit"}']['count'], 4)
+
+    def test_zero_disables_the_limit(self):
+        limiter = catcher.RateLimiter(0)
+        start = time.monotonic()
+        for _ in range(100):
+            limiter.wait('https://www.tadpoles.com/a')
+        self.assertLess(time.monotonic() - start, 0.04)
+
+
+    def test_burst_goes_out_back_to_back(self):
+        limiter = catcher.RateLimiter(10, burst=3)
+        start = time.monotonic()
+        for _ in range(3):
+            limiter.wait('https://www.tadpoles.com/a')
+        self.assertLess(time.monotonic() - start, 0.04)
+        limiter.wait('https://www.tadpoles.com/a')
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+
+class BandwidthLimiterTest(unittest.TestCase):
+    def test_bytes_over_the_cap_wait(self):
+        metrics = catcher.Metrics()
+        limiter = catcher.BandwidthLimiter(10000, metrics=metrics)
+        start = time.monotonic()
+        limiter.consume(10000)
+        self.assertLess(time.monotonic() - start, 0.04)
+        limiter.consume(2000)
+        self.assertGreaterEqual(time.monotonic() - start, 0.19)
+        self.assertEqual(metrics.summary()['histograms']['wait_seconds{kind="bandwidth"}']['count'], 1)
+
+
+class WaitTest(TempDirTest):
+    class Browser(object):
+        """Timeline that grows by one item per poll until it has count items"""
+        def __init__(self, count):
+            self.count = count
+            self.items = 0
+
+        def execute_script(self, script):
+            self.items = min(self.count, self.items + 1)
+            return self.items
+
+    def client(self):
+        cfg = make_config()
+        cfg['CRAWLER'] = {'page_timeout': '1', 'poll_interval': '0.001'}
+        return catcher.Client(cfg)
+
+    def test_waits_until_the_timeline_settles(self):
+        client = self.client()
+        client.browser = self.Browser(5)
+        self.assertTrue(client.wait_for(catcher.TimelineSettled('div'), 'page', 'the timeline'))
+        self.assertEqual(client.browser.items, 5)
+        self.assertEqual(client.metrics.summary()['histograms']['wait_seconds{kind="page"}']['count'], 1)
+
+    def test_timeout_is_only_fatal_when_required(self):
+        client = self.client()
+        client.config['CRAWLER']['page_timeout'] = '0.05'
+        client.browser = self.Browser(10 ** 9)
+        self.assertIsNone(client.wait_for(catcher.TimelineSettled('div'), 'page', 'the timeline'))
+        with self.assertRaises(catcher.TimeoutException):
+            client.wait_for(catcher.TimelineSettled('div'), 'modal', 'a report', required=True)
+
+
+class TimelineTest(TempDirTest):
+    class Browser(object):
+        """Timeline page of records, as read by TIMELINE_SCRIPT"""
+        def __init__(self, records):
+            self.records = records
+
+        def execute_script(self, script, *args):
+            if not args:
+                # timeline_marker, or the item count of TimelineSettled
+                return None if 'querySelector(' in script else len(self.records)
+            start, count = args
+            return [dict(record, index=ind + 1) for ind, record in enumerate(self.records)][start:start + count]
+
+    class Month(object):
+        text = 'Mar'
+
+        def click(self):
+            pass
+
+    @staticmethod
+    def media(key):
+        return {'id': 'tl-' + key, 'outerText': '',
+                'style': 'background-image: url("/remote/v1/obj_attachment?obj=e&thumbnail=true&key=%s");' % key}
+
+    @staticmethod
+    def report(day):
+        return {'id': 'tl-report', 'style': '', 'outerText': 'Daily report\n03/%02d/2021' % day}
+
+    def crawl(self, records, window):
+        cfg = make_config()
+        cfg['CRAWLER'] = {'timeline_window': str(window), 'page_timeout': '1', 'poll_interval': '0.001'}
+        client = catcher.Client(cfg, download_reports=False, full_sync=True)
+        client.app_params = {}
+        client.browser = self.Browser(records)
+        client.wait_for_timeline = lambda marker: None
+
+        def iter_monthyear():
+            client.current_year_text, client.current_month_text = '2021', '03'
+            yield self.Month()
+        client.iter_monthyear = iter_monthyear
+        return client, list(client.iter_urls())
+
+    def test_media_without_a_report_in_the_window_gets_a_provisional_date(self):
+        records = [self.media('K0'), self.media('K1'), self.report(20),
+                   self.media('K2'), self.media('K3'), self.media('K4'), self.media('K5'), self.report(10)]
+        client, items = self.crawl(records, window=3)
+        dates = {item.key: item.date for item in items if isinstance(item, catcher.Image)}
+        self.assertEqual(dates, {'K0': 20, 'K1': 20, 'K2': 20, 'K3': 20, 'K4': 20, 'K5': 10})
+        self.assertEqual([item.date_text for item in items if isinstance(item, catcher.Report)], ['20', '10'])
+        self.assertEqual(client.metrics.get('provisional_dates'), 3)
+
+    def test_media_is_dated_by_the_next_report_within_the_window(self):
+        records = [self.media('K0'), self.media('K1'), self.report(20), self.media('K2'), self.report(10)]
+        client, items = self.crawl(records, window=3)
+        self.assertEqual([getattr(item, 'key', item.date_text) for item in items], ['K1', 'K0', '20', 'K2', '10'])
+        self.assertEqual([item.date for item in items if isinstance(item, catcher.Image)], [20, 20, 10])
+        self.assertEqual(client.metrics.get('provisional_dates'), 0)
+
+
+class DownloadQueueTest(unittest.TestCase):
+    def test_every_job_is_handled_before_close_returns(self):
+        done = []
+        lock = threading.Lock()
+
+        def handler(job):
+            time.sleep(0.001)
+            with lock:
+                done.append(job)
+        downloads = catcher.DownloadQueue(handler, concurrency=4, max_pending=2, logger=logging.getLogger('test'))
+        downloads.start()
+        for job in range(50):
+            downloads.put(job)
+        downloads.close()
+        self.assertEqual(sorted(done), list(range(50)))
+
+
+class ImageTest(unittest.TestCase):
+    def test_same_id_with_either_backend(self):
+        account = FakeAccount(children=1, months=1, items_per_month=6, days_per_month=2)
+        year, month = account.months[0]
+        records = [record for record in account.timeline(0, year, month) if 'style' in record]
+        self.assertIn('thumbnail=true")', ''.join(record['style'] for record in records))
+        for record in records:
+            self.assertTrue(catcher.Image.is_image(record))
+            img = catcher.Image.from_record(record)
+            self.assertIn(img.key, account.media)
+            self.assertNotIn('thumbnail', img.url)
+            api = catcher.Image('https://www.tadpoles.com/remote/v1/obj_attachment?obj=e1&key=' + img.key)
+            self.assertEqual(img.id, api.id)
+            self.assertEqual(img.id, catcher.Image.make_id(img.key))
+
+
+class CheckFileTest(TempDirTest):
+    def test_valid_files(self):
+        files = {
+            'a.jpg': b'\xff\xd8\xff\xe0' + b'x' * 100,
+            'a.png': b'\x89PNG\r\n\x1a\n' + b'x' * 100 + b'\x00\x00\x00\x00IEND\xaeB`\x82',
+            'a.mp4': b'\x00\x00\x00\x18ftypmp42' + b'x' * 100,
+            'a.html': b'<html><h1>Report</h1></html>',
+            'a.html.gz': gzip.compress(b'<html><h1>Report</h1></html>'),
+        }
+        for name, content in files.items():
+            self.assertIsNone(catcher.check_file(self.write(name, content), len(content)), name)
+
+    def test_broken_files(self):
+        self.assertEqual(catcher.check_file(join(self.workdir, 'missing.jpg')), 'missing')
+        self.assertEqual(catcher.check_file(self.write('empty.jpg', b'')), 'empty')
+        self.assertIn('instead of', catcher.check_file(self.write('short.jpg', b'\xff\xd8\xff'), 100))
+        self.assertEqual(catcher.check_file(self.write('text.jpg', b'not an image')), 'not a jpg file')
+        self.assertIn('end chunk', catcher.check_file(self.write('cut.png', b'\x89PNG\r\n\x1a\n' + b'x' * 100)))
+        content = gzip.compress(b'<html>' + os.urandom(1000) + b'</html>')
+        self.assertIn('unreadable', catcher.check_file(self.write('cut.html.gz', content[:len(content) // 2])))
+
+
+class ManifestTest(TempDirTest):
+    def add(self, manifest, key, name, **kwargs):
+        path = self.write(join('download', name), b'\xff\xd8\xff' + key.encode())
+        return manifest.add(key, path, 'image/jpeg', os.path.getsize(path), 'sum-' + key, **kwargs)
+
+    def test_entries_survive_a_reload(self):
+        manifest = catcher.Manifest('download')
+        self.add(manifest, 'kid/2021/03/a', 'kid/2021/03/tadpoles-kid-2021-03-04-a.jpg', source='KEY-A')
+        reloaded = catcher.Manifest('download')
+        reloaded.load()
+        self.assertIn('kid/2021/03/a', reloaded)
+        self.assertEqual(reloaded.find_blob(source='KEY-A')['key'], 'kid/2021/03/a')
+        self.assertEqual(reloaded.find_blob(checksum='sum-kid/2021/03/a')['key'], 'kid/2021/03/a')
+
+    def test_moved_and_removed_entries(self):
+        manifest = catcher.Manifest('download')
+        self.add(manifest, 'kid/2021/03/old', 'kid/2021/03/tadpoles-kid-2021-03-04-old.jpg', source='KEY-A')
+        self.add(manifest, 'kid/2021/03/new', 'kid/2021/03/tadpoles-kid-2021-03-04-new.jpg', source='KEY-A',
+                 moved_from='kid/2021/03/old')
+        self.add(manifest, 'kid/2021/03/gone', 'kid/2021/03/tadpoles-kid-2021-03-05-gone.jpg')
+        manifest.remove('kid/2021/03/gone')
+        reloaded = catcher.Manifest('download')
+        reloaded.load()
+        self.assertEqual(sorted(reloaded.entries), ['kid/2021/03/new'])
+        self.assertEqual(reloaded.find_renamed('kid/2021/03/other', 'KEY-A')['key'], 'kid/2021/03/new')
+
+    def test_rebuild_keeps_known_sources(self):
+        manifest = catcher.Manifest('download')
+        self.add(manifest, 'kid/2021/03/a', 'kid/2021/03/tadpoles-kid-2021-03-04-a.jpg', source='KEY-A')
+        self.write('download/kid/2021/03/tadpoles-kid-2021-03-05.html', b'<html></html>')
+        manifest.rebuild(logging.getLogger('test'))
+        self.assertEqual(sorted(manifest.entries), ['kid/2021/03/a', 'kid/2021/03/report-05'])
+        self.assertEqual(manifest.get('kid/2021/03/a')['source'], 'KEY-A')
+
+
+class SyncStateTest(TempDirTest):
+    def test_save_merges_marks(self):
+        state = catcher.SyncState('download')
+        state.save({'ann': {'year': '2020', 'month': '12', 'last_id': 'a'}})
+        state = catcher.SyncState('download')
+        state.load()
+        state.save({'ben': {'year': '2020', 'month': '11', 'last_id': 'b'}})
+        with open(state.path) as state_file:
+            self.assertEqual(sorted(json.load(state_file)), ['ann', 'ben'])
+        self.assertLess(catcher.SyncState.month_key('2020', '9'), catcher.SyncState.month_key('2020', '10'))
+
+
+class CookieTest(TempDirTest):
+    def test_secure_cookies_stay_secure(self):
+        client = catcher.Client(make_config())
+        client.cookies = [{'name': 'session', 'value': '1', 'domain': 'www.tadpoles.com', 'path': '/',
+                           'secure': True, 'httpOnly': True}]
+        client.requestify_cookies()
+        cookie, = client.session.cookies
+        self.assertTrue(cookie.secure)
+        self.assertTrue(cookie.has_nonstandard_attr('HttpOnly'))
+        for url, sent in (('http://www.tadpoles.com/parents', False), ('https://www.tadpoles.com/parents', True)):
+            request = client.session.prepare_request(requests.Request('GET', url))
+            self.assertEqual('Cookie' in request.headers, sent, url)
+
+
+class ReportAssetTest(TempDirTest):
+    class Session(object):
+        def __init__(self):
+            self.urls = []
+
+        def get(self, url, timeout=None):
+            self.urls.append(url)
+            resp = requests.Response()
+            resp.status_code, resp._content = 200, b'\x89PNG'
+            resp.headers['content-type'] = 'image/png'
+            return resp
+
+    def test_only_tadpoles_https_urls_are_fetched(self):
+        client = catcher.Client(make_config())
+        client.session = self.Session()
+        client.rate_limiter = catcher.RateLimiter(0)
+        self.assertEqual(client.fetch_report_asset('/media/a.png', 'inline', 'files', 0), 'data:image/png;base64,iVBORw==')
+        for src in ('http://www.tadpoles.com/media/b.png', 'https://example.com/c.png',
+                    'https://tadpoles.com.example.com/d.png'):
+            self.assertIsNone(client.fetch_report_asset(src, 'inline', 'files', 0), src)
+        self.assertEqual(client.session.urls, ['https://www.tadpoles.com/media/a.png'])
+
+
+class ParallelCrawlTest(TempDirTest):
+    def test_failed_crawl_keeps_the_previous_sync_mark(self):
+        client = catcher.Client(make_config())
+        client.app_params = {'children': [{'display_name': 'Ann Test'}, {'display_name': 'Ben Test'}]}
+
+        def crawl_child(child):
+            client.current_child_ind = child
+            client.record_sync_mark('2021', '03', 'abc')
+            if child == 0:
+                # What find_by_xpath does when an element is missing
+                sys.exit(0)
+        client.crawl_child = crawl_child
+        # One at a time, as both share current_child_ind here
+        client.crawl_in_parallel(1)
+        self.assertEqual(sorted(client.sync_marks), ['ben'])
+        self.assertEqual(client.metrics.summary()['counters']['crawl_failures'], 1)
+
+    def test_links_made_by_a_worker_are_counted_once(self):
+        client = catcher.Client(make_config())
+        client.manifest = catcher.Manifest('download')
+        path = self.write('download/ann/2021/03/tadpoles-ann-2021-03-04-a.jpg', b'\xff\xd8\xff' * 100)
+        blob = client.manifest.add('ann/2021/03/a', path, 'image/jpeg', 300, 'sum', source='KEY-A')
+        # As in spawn
+        worker = copy.copy(client)
+        self.assertTrue(worker.link_blob(blob, join(self.workdir, 'download/ben-a.jpg')))
+        self.assertEqual(client.metrics.get('deduped_files'), 1)
+        self.assertEqual(client.metrics.get('deduped_bytes'), 300)
+
+
+class AccountConfigTest(unittest.TestCase):
+    def test_metrics_files_keep_their_directory(self):
+        cfg = make_config()
+        cfg['METRICS'] = {'json_file': '/data/metrics/run.json', 'prometheus_file': '/var/lib/node/tadpoles.prom'}
+        account = ConfigParser()
+        account['account:smith'] = {'username': 'smith@example.com'}
+        metrics = catcher.account_config(cfg, 'smith', account['account:smith'])['METRICS']
+        self.assertEqual(metrics['json_file'], '/data/metrics/run-smith.json')
+        self.assertEqual(metrics['prometheus_file'], '/var/lib/node/tadpoles-smith.prom')
+
+        cfg['METRICS'] = {'json_file': ''}
+        metrics = catcher.account_config(cfg, 'smith', account['account:smith'])['METRICS']
+        self.assertEqual(metrics['json_file'], '')
+        self.assertEqual(metrics.get('prometheus_file', fallback=''), '')
+
+
+class FakeServerTest(TempDirTest):
+    '''Runs the api backend against a FakeTadpoles server with a warm session'''
+    def setUp(self):
+        super().setUp()
+        self.account = FakeAccount(children=2, months=2, items_per_month=4, days_per_month=2,
+                                   media_size=64 * 1024, video_ratio=0.25)
+        self.server = None
+        self.saved = {name: getattr(catcher.Client, name) for name in ('ROOT_URL', 'HOME_URL')}
+        self.saved_base = catcher.Image.BASE_URL
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.stop()
+        for name, value in self.saved.items():
+            setattr(catcher.Client, name, value)
+        catcher.Image.BASE_URL = self.saved_base
+        super().tearDown()
+
+    def start_server(self, **kwargs):
+        if self.server is not None:
+            self.server.stop()
+        self.server = FakeTadpoles(self.account, **kwargs).start()
+        catcher.Client.ROOT_URL = self.server.url + '/parents'
+        catcher.Client.HOME_URL = self.server.url + '/parents'
+        catcher.Image.BASE_URL = self.server.url
+        with open(catcher.Client.COOKIE_FILE, 'wb') as file:
+            pickle.dump([{'name': SESSION_COOKIE, 'value': '1', 'domain': '127.0.0.1', 'path': '/'}], file)
+
+    def make_config(self):
+        return make_config(self.server.url)
+
+    def run_client(self):
+        with catcher.Client(self.make_config()) as client:
+            client.download_images()
+        return client
+
+    def media_saved(self, client):
+        return [entry for entry in client.manifest.entries.values() if entry['type'] != 'text/html']
+
+    def test_everything_is_saved(self):
+        self.start_server()
+        client = self.run_client()
+        self.assertEqual(len(self.media_saved(client)), self.account.media_count)
+        self.assertEqual(len(client.manifest) - self.account.media_count, self.account.report_count)
+        for entry in client.manifest.entries.values():
+            self.assertIsNone(catcher.check_file(join(client.manifest.root, entry['path']), entry['size']))
+
+    def ready_client(self, cfg=None):
+        """A client with a session and download workers, as download_images sets it up"""
+        client = catcher.Client(cfg or self.make_config())
+        client.init_session()
+        client.resume_session()
+        client.init_manifest()
+        client.init_downloads()
+        client.current_year_text, client.current_month_text = '2020', '12'
+        return client
+
+    def image(self, client, key, child='Ann'):
+        """Image of attachment key on child's timeline, in December 2020"""
+        client.get_child_name = lambda child_ind=None: child
+        return client.locate(catcher.Image('%s/remote/v1/obj_attachment?key=%s' % (self.server.url, key), date=1))
+
+    def save_old_file(self, client, key, _id, source=None):
+        """A file of key saved by an older version under id"""
+        filename = '%s01-%s.%s' % (client.path_prefix('ann', '2020', '12'), _id,
+                                   'mp4' if self.account.media[key]['type'] == 'video/mp4' else 'jpg')
+        payload = self.account.payload(key)
+        os.makedirs(dirname(filename), exist_ok=True)
+        with open(filename, 'wb') as file:
+            file.write(payload)
+        return client.manifest.add(catcher.Manifest.make_key('ann', '2020', '12', _id), filename,
+                                   self.account.media[key]['type'], len(payload),
+                                   hashlib.sha256(payload).hexdigest(), source=source)
+
+    def test_file_of_the_browser_backend_is_renamed(self):
+        self.start_server()
+        client = self.ready_client()
+        key = sorted(self.account.media)[0]
+        # Named after the div id, but downloaded from the same key
+        old = self.save_old_file(client, key, catcher.Image.make_id('div1234'), source=key)
+        img = self.image(client, key)
+        client.save_image(img)
+        client.downloads.close()
+        self.assertEqual(self.server.stats['media'], 0)
+        self.assertEqual(sorted(client.manifest.entries), [img.index_key])
+        self.assertTrue(os.path.isfile(join(client.manifest.root, client.manifest.get(img.index_key)['path'])))
+        self.assertFalse(os.path.isfile(join(client.manifest.root, old['path'])))
+
+    def test_file_with_a_legacy_name_is_renamed(self):
+        self.start_server()
+        client = self.ready_client()
+        key = sorted(self.account.media)[0]
+        # Named after the second half of the key, from before sources were recorded
+        old = self.save_old_file(client, key, catcher.Image.legacy_id(key))
+        img = self.image(client, key)
+        client.save_image(img)
+        client.downloads.close()
+        self.assertEqual(self.server.stats['media'], 0)
+        self.assertEqual(sorted(client.manifest.entries), [img.index_key])
+        self.assertFalse(os.path.isfile(join(client.manifest.root, old['path'])))
+        self.assertEqual(client.metrics.get('files_migrated'), 1)
+
+    def test_legacy_name_of_another_photo_is_left_alone(self):
+        self.start_server()
+        client = self.ready_client()
+        key = sorted(self.account.media)[0]
+        # Same second half of the key, but downloaded from another one
+        old = self.save_old_file(client, key, catcher.Image.legacy_id(key), source='OTHER-KEY')
+        img = self.image(client, key)
+        client.save_image(img)
+        client.downloads.close()
+        self.assertEqual(self.server.stats['media'], 1)
+        self.assertEqual(sorted(client.manifest.entries), sorted([old['key'], img.index_key]))
+
+    def test_every_month_is_renamed_at_the_start_of_a_run(self):
+        self.start_server()
+        client = self.ready_client()
+        keys = sorted(self.account.media)
+        known = self.save_old_file(client, keys[0], catcher.Image.legacy_id(keys[0]), source=keys[0])
+        unknown = self.save_old_file(client, keys[1], catcher.Image.legacy_id(keys[1]))
+        client.downloads.close()
+        client.migrate_names()
+        new_key = catcher.Manifest.make_key('ann', '2020', '12', catcher.Image.make_id(keys[0]))
+        self.assertEqual(sorted(client.manifest.entries), sorted([new_key, unknown['key']]))
+        self.assertTrue(os.path.isfile(join(client.manifest.root, client.manifest.get(new_key)['path'])))
+        self.assertFalse(os.path.isfile(join(client.manifest.root, known['path'])))
+        # Also after a restart
+        manifest = catcher.Manifest('download')
+        manifest.load()
+        self.assertEqual(sorted(manifest.entries), sorted(client.manifest.entries))
+
+    def test_rebuild_index_renames_known_keys(self):
+        self.start_server()
+        client = self.ready_client()
+        key = sorted(self.account.media)[0]
+        self.save_old_file(client, key, catcher.Image.legacy_id(key), source=key)
+        client.downloads.close()
+        client = catcher.Client(self.make_config())
+        client.rebuild_index()
+        new_key = catcher.Manifest.make_key('ann', '2020', '12', catcher.Image.make_id(key))
+        self.assertEqual(sorted(client.manifest.entries), [new_key])
+        self.assertEqual(client.manifest.get(new_key)['source'], key)
+
+    def saved_path(self, client, img):
+        return join(client.manifest.root, client.manifest.get(img.index_key)['path'])
+
+    def test_same_photo_of_two_children_is_linked(self):
+        self.start_server()
+        client = self.ready_client()
+        key = sorted(self.account.media)[0]
+        first, second = self.image(client, key, 'Ann'), self.image(client, key, 'Ben')
+        client.save_image(first)
+        client.save_image(second)
+        client.downloads.close()
+        self.assertEqual(self.server.stats['media'], 1)
+        self.assertTrue(os.path.samefile(self.saved_path(client, first), self.saved_path(client, second)))
+        self.assertEqual(client.metrics.get('downloads_deduped'), 1)
+        self.assertEqual(client.metrics.get('deduped_bytes'), len(self.account.payload(key)))
+
+    def test_same_content_under_another_key_is_linked(self):
+        self.start_server()
+        client = self.ready_client()
+        key = sorted(self.account.media)[0]
+        old = self.save_old_file(client, key, 'other', source='OTHER-KEY')
+        img = self.image(client, key, 'Ben')
+        client.save_image(img)
+        client.downloads.close()
+        self.assertEqual(self.server.stats['media'], 1)
+        self.assertTrue(os.path.samefile(self.saved_path(client, img), join(client.manifest.root, old['path'])))
+
+    def test_dedupe_off_keeps_separate_copies(self):
+        self.start_server()
+        cfg = self.make_config()
+        cfg['DOWNLOADS']['dedupe'] = 'off'
+        client = self.ready_client(cfg)
+        key = sorted(self.account.media)[0]
+        first, second = self.image(client, key, 'Ann'), self.image(client, key, 'Ben')
+        client.save_image(first)
+        client.save_image(second)
+        client.downloads.close()
+        self.assertEqual(self.server.stats['media'], 2)
+        self.assertFalse(os.path.samefile(self.saved_path(client, first), self.saved_path(client, second)))
+
+    def test_reflink_falls_back_to_a_hardlink_without_fcntl(self):
+        self.start_server()
+        cfg = self.make_config()
+        cfg['DOWNLOADS']['dedupe'] = 'reflink'
+        client = self.ready_client(cfg)
+        key = sorted(self.account.media)[0]
+        first, second = self.image(client, key, 'Ann'), self.image(client, key, 'Ben')
+        client.save_image(first)
+        fcntl, catcher.fcntl = catcher.fcntl, None
+        try:
+            # As on Windows
+            client.save_image(second)
+        finally:
+            catcher.fcntl = fcntl
+        client.downloads.close()
+        self.assertTrue(os.path.samefile(self.saved_path(client, first), self.saved_path(client, second)))
+
+    def write_batch(self, bandwidth_limit=0):
+        for name in ('alice', 'bob'):
+            with open('cookies-%s.pkl' % name, 'wb') as file:
+                pickle.dump([{'name': SESSION_COOKIE, 'value': '1', 'domain': '127.0.0.1', 'path': '/'}], file)
+        with open('accounts.ini', 'w') as file:
+            file.write('[BATCH]\nconcurrency = 2\nworkers = 2\nbandwidth_limit = %d\n\n'
+                       '[account:alice]\n\n[account:bob]\n' % bandwidth_limit)
+
+    def test_batch_syncs_every_account(self):
+        self.start_server()
+        self.write_batch()
+        cfg = self.make_config()
+        cfg['METRICS']['json_file'] = 'metrics.json'
+        self.assertEqual(catcher.run_batch(cfg, 'accounts.ini'), [])
+        for name in ('alice', 'bob'):
+            manifest = catcher.Manifest(join('download', name))
+            manifest.load()
+            self.assertEqual(len(manifest), self.account.media_count + self.account.report_count)
+            self.assertTrue(os.path.isfile(join('download', name, catcher.SyncState.FILE_NAME)))
+            self.assertTrue(os.path.isfile('metrics-%s.json' % name))
+        # The shared limits are measured for the whole batch
+        self.assertTrue(os.path.isfile('metrics.json'))
+
+    @unittest.skipIf(os.name == 'nt', 'needs SIGINT')
+    def test_interrupted_batch_stops_without_saving_sync_marks(self):
+        # Slow enough that the batch is still running when interrupted
+        self.start_server(media_latency=0.2)
+        self.write_batch(bandwidth_limit=64)
+        timer = threading.Timer(0.5, os.kill, (os.getpid(), signal.SIGINT))
+        timer.start()
+        start = time.monotonic()
+        with self.assertRaises(KeyboardInterrupt):
+            catcher.run_batch(self.make_config(), 'accounts.ini')
+        timer.join()
+        self.assertLess(time.monotonic() - start, 10)
+        for name in ('alice', 'bob'):
+            self.assertFalse(os.path.exists(join('download', name, catcher.SyncState.FILE_NAME)))
+        self.assertFalse([thread for thread in threading.enumerate() if thread.name.startswith('download-')])
+
+    def test_truncated_body_resumes(self):
+        self.start_server(truncate_rate=1.0)
+        client = self.ready_client()
+        key = sorted(self.account.media)[0]
+        img = self.image(client, key)
+        download_part = client.download_part
+
+        def cut_once(url, filename_part):
+            # Only the first response is cut off half way
+            try:
+                return download_part(url, filename_part)
+            finally:
+                self.server.truncate_rate = 0.0
+        client.download_part = cut_once
+        client.save_image(img)
+        client.downloads.close()
+
+        entry = client.manifest.get(img.index_key)
+        payload = self.account.payload(key)
+        self.assertEqual(entry['size'], len(payload))
+        with open(join(client.manifest.root, entry['path']), 'rb') as file:
+            self.assertEqual(file.read(), payload)
+        self.assertEqual(client.metrics.summary()['counters']['download_resumes'], 1)
+        self.assertFalse([name for _, _, names in os.walk('download') for name in names if name.endswith('.part')])
+
+    def test_failed_download_is_retried_on_the_next_incremental_run(self):
+        self.start_server(failure_rate=1.0)
+        client = self.run_client()
+        self.assertEqual(self.media_saved(client), [])
+        self.assertFalse(os.path.exists(client.sync_state.path))
+
+        self.start_server()
+        client = self.run_client()
+        self.assertEqual(len(self.media_saved(client)), self.account.media_count)
+        self.assertTrue(os.path.exists(client.sync_state.path))
+
+    def test_verify_downloads_broken_files_again(self):
+        self.start_server()
+        client = self.run_client()
+        media = sorted(entry['path'] for entry in self.media_saved(client))
+        with open(join(client.manifest.root, media[0]), 'r+b') as file:
+            file.truncate(10)
+
+        self.assertEqual(catcher.Client(self.make_config()).verify(), (1, 0))
+        cfg = self.make_config()
+        cfg['METRICS']['json_file'] = 'metrics.json'
+        self.assertEqual(catcher.Client(cfg).verify(), (0, 0))
+        with open('metrics.json') as metrics_file:
+            self.assertIn('verify_seconds{kind="local"}', json.load(metrics_file)['histograms'])
+
+    def test_verify_reports_failed_repairs(self):
+        self.start_server()
+        client = self.run_client()
+        media = sorted(entry['path'] for entry in self.media_saved(client))
+        with open(join(client.manifest.root, media[0]), 'r+b') as file:
+            file.truncate(10)
+
+        self.server.failure_rate = 1.0
+        client = catcher.Client(self.make_config())
+        self.assertEqual(client.verify(), (1, 1))
+        self.assertEqual(client.metrics.get('verify_failed'), 1)
+        # Still in the manifest, so the next --verify tries again
+        self.assertEqual(catcher.Client(self.make_config()).verify(check_remote=False), (1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()